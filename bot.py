@@ -1,16 +1,30 @@
+import time
+_IMPORT_STARTED = time.perf_counter()   # the startup report counts the imports below too
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 from discord import app_commands
-from groq import Groq
 import asyncio
-import time
+import bisect
 import traceback
 import random
+import re
+import heapq
+import itertools
+import hashlib
 import json
 import os
-from datetime import datetime, timedelta
+import sqlite3
+import sys
+import threading
+from array import array
+from collections import Counter, OrderedDict, deque
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
 import aiohttp
+from aiohttp import web
 from typing import Optional
+from urllib.parse import urlsplit
 from dotenv import load_dotenv
 
 # ================= LOAD ENV =================
@@ -19,63 +33,1006 @@ load_dotenv()
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 PREFIX = os.getenv("PREFIX", ".")
+MEMBERS_INTENT = os.getenv("MEMBERS_INTENT", "1") == "1"   # member join/update events; not needed by any command
 RESTART_DELAY = int(os.getenv("RESTART_DELAY", "5"))
-DATA_FILE = "data.json"
+DATA_FILE = os.getenv("DATA_FILE", "data.json")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()   # "json" or "sqlite"
+DB_FILE = os.getenv("DB_FILE", "data.db")
 
-# =========================================
+def parse_shard_ids(raw: str) -> Optional[list[int]]:
+    """Turn "0-3,8" into [0, 1, 2, 3, 8]."""
+    if not raw:
+        return None
+    ids = []
+    for part in raw.split(","):
+        lo, _, hi = part.strip().partition("-")
+        ids.extend(range(int(lo), int(hi or lo) + 1))
+    return ids
+
+# Sharding: SHARDED=1 runs an AutoShardedBot. Leave SHARD_COUNT/SHARD_IDS unset
+# to let Discord pick, or set both so several processes each run a slice.
+SHARDED     = os.getenv("SHARDED", "0") == "1"
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+SHARD_IDS   = parse_shard_ids(os.getenv("SHARD_IDS", ""))
+# Per-process files get the shard slice in their name so processes never share one
+SHARD_FILE_SUFFIX = f".shards-{os.getenv('SHARD_IDS').replace(',', '_')}" if SHARD_IDS else ""
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))   # 0 disables the /metrics endpoint
 
-groq_client = Groq(api_key=GROQ_API_KEY)
+# =========================================
 
 # ============== PERSISTENT STORAGE ==================
-# All data is saved to data.json so it survives restarts.
+# Data is saved to data.json (or data.db with STORAGE_BACKEND=sqlite) so it
+# survives restarts. Commands never write to disk themselves: they mark the
+# records they touched and the write-behind flusher below batches those up.
+
+DATA_FLUSH_INTERVAL  = float(os.getenv("DATA_FLUSH_INTERVAL", "10"))   # seconds between flushes
+DATA_FLUSH_THRESHOLD = int(os.getenv("DATA_FLUSH_THRESHOLD", "200"))   # dirty records that force an early flush
+
+SECTIONS = ("user_points", "user_stats", "user_personas", "daily_claimed")
+EPOCH    = date(1970, 1, 1)
+_MISSING = object()
+
+def _write_json_atomic(path: str, payload: dict):
+    """Write to a temp file and rename over the target so a crash never truncates it."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(payload, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class JsonStorage:
+    """The data.json file. Every flush rewrites the whole file.
+
+    The writer thread keeps its own copy of the record columns. A flush only
+    copies the dirty users' rows on the event loop; merging them into that
+    copy and serializing the file both happen in the writer thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._columns: list[array] = UserRecords().columns()   # owned by the writer thread
+        self._persona_names: list[str] = []
+
+    def load(self):
+        """Load persisted data from disk. Returns defaults if file missing."""
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    raw = json.load(f)
+                # JSON keys are always strings — convert user IDs back to int
+                user_points   = {int(k): v for k, v in raw.get("user_points", {}).items()}
+                user_stats_raw = raw.get("user_stats", {})
+                user_stats = {}
+                for k, v in user_stats_raw.items():
+                    user_stats[int(k)] = {
+                        "commands_used": v["commands_used"],
+                        "last_seen": datetime.fromisoformat(v["last_seen"])
+                    }
+                user_personas = {int(k): v for k, v in raw.get("user_personas", {}).items()}
+                daily_claimed = {int(k): v for k, v in raw.get("daily_claimed", {}).items()}
+                return user_points, user_stats, user_personas, daily_claimed
+            except Exception as e:
+                print(f"⚠️  Could not load {self.path}: {e}. Starting fresh.")
+        return {}, {}, {}, {}
+
+    def seed(self, records: "UserRecords"):
+        """Start the writer's copy from freshly loaded records, before the event loop sees them."""
+        self._columns = records.columns()
+        self._persona_names = list(records.persona_names)
+
+    def snapshot(self, dirty: set, records: "UserRecords") -> tuple:
+        return records.rows({uid for _, uid in dirty}), list(records.persona_names)
+
+    def write(self, batch: tuple):
+        rows, self._persona_names = batch
+        for row, *values in rows:
+            for column, value in zip(self._columns, values):
+                if row >= len(column):   # a user added since the last flush
+                    column.extend([0] * (row + 1 - len(column)))
+                column[row] = value
+        ids, present, points, commands_used, last_seen, persona, daily = self._columns
+        persona_names = self._persona_names
+        payload = {section: {} for section in SECTIONS}
+        user_points, user_stats, user_personas, daily_claimed = payload.values()
+        for uid, bits, pts, used, seen, code, day in zip(ids, present, points, commands_used, last_seen, persona, daily):
+            key = str(uid)
+            if bits & UserRecords.POINTS:
+                user_points[key] = pts
+            if bits & UserRecords.STATS:
+                user_stats[key] = {"commands_used": used, "last_seen": datetime.fromtimestamp(seen).isoformat()}
+            if bits & UserRecords.PERSONA:
+                user_personas[key] = persona_names[code]
+            if bits & UserRecords.DAILY:
+                daily_claimed[key] = (EPOCH + timedelta(days=day)).isoformat()
+        _write_json_atomic(self.path, payload)
+
+    def close(self):
+        pass
 
-def load_data():
-    """Load persisted data from disk. Returns defaults if file missing."""
-    if os.path.exists(DATA_FILE):
+class SqliteStorage:
+    """SQLite storage in WAL mode. A flush upserts only the rows that changed.
+
+    Each section maps onto columns of one `users` row; a NULL column means the
+    user has no record in that section. On first start an existing data.json
+    is migrated and renamed so it is never imported twice.
+    """
+
+    COLUMNS = {
+        "user_points":   ("points",),
+        "user_stats":    ("commands_used", "last_seen"),
+        "user_personas": ("persona",),
+        "daily_claimed": ("daily_claimed",),
+    }
+
+    def __init__(self, path: str, legacy_json: str):
+        self.path        = path
+        self.legacy_json = legacy_json
+        self._lock = threading.Lock()   # flushes run in worker threads; close() must not race one
+        self.conn  = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id       INTEGER PRIMARY KEY,
+                points        INTEGER,
+                commands_used INTEGER,
+                last_seen     TEXT,
+                persona       TEXT,
+                daily_claimed TEXT
+            );
+            -- Rankings come from RankedIndex, so nothing queries these; they only slowed every flush
+            DROP INDEX IF EXISTS idx_users_points;
+            DROP INDEX IF EXISTS idx_users_last_seen;
+        """)
+
+    def _migrate(self):
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] >= 1:
+            return
+        if os.path.exists(self.legacy_json):
+            legacy = UserRecords.from_sections(*JsonStorage(self.legacy_json).load())
+            dirty = {(section, uid) for section, flag in UserRecords.FLAGS.items() for uid in legacy.ids(flag)}
+            self.write(self.snapshot(dirty, legacy))
+            os.replace(self.legacy_json, f"{self.legacy_json}.migrated")
+            print(f"📦 Migrated {legacy.count(UserRecords.POINTS)} point records from {self.legacy_json} to {self.path}")
+        self.conn.execute("PRAGMA user_version = 1")
+
+    def load(self):
+        self._migrate()
+        user_points, user_stats, user_personas, daily_claimed = {}, {}, {}, {}
+        rows = self.conn.execute(
+            "SELECT user_id, points, commands_used, last_seen, persona, daily_claimed FROM users"
+        )
+        for uid, points, commands_used, last_seen, persona, claimed in rows:
+            if points is not None:
+                user_points[uid] = points
+            if commands_used is not None:
+                user_stats[uid] = {"commands_used": commands_used, "last_seen": datetime.fromisoformat(last_seen)}
+            if persona is not None:
+                user_personas[uid] = persona
+            if claimed is not None:
+                daily_claimed[uid] = claimed
+        return user_points, user_stats, user_personas, daily_claimed
+
+    def snapshot(self, dirty: set, records: "UserRecords") -> list:
+        """Turn dirty records into (section, user_id, column values or None) rows."""
+        ops = []
+        for section, uid in dirty:
+            value = records.get(UserRecords.FLAGS[section], uid)
+            if value is None:
+                ops.append((section, uid, None))
+            elif section == "user_stats":
+                ops.append((section, uid, (value["commands_used"], value["last_seen"].isoformat())))
+            else:
+                ops.append((section, uid, (value,)))
+        return ops
+
+    def write(self, ops: list):
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                for section, uid, values in ops:
+                    cols = self.COLUMNS[section]
+                    if values is None:
+                        assignments = ", ".join(f"{c} = NULL" for c in cols)
+                        self.conn.execute(f"UPDATE users SET {assignments} WHERE user_id = ?", (uid,))
+                    else:
+                        updates = ", ".join(f"{c} = excluded.{c}" for c in cols)
+                        self.conn.execute(
+                            f"INSERT INTO users (user_id, {', '.join(cols)}) VALUES (?{', ?' * len(cols)}) "
+                            f"ON CONFLICT(user_id) DO UPDATE SET {updates}",
+                            (uid, *values)
+                        )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def seed(self, records: "UserRecords"):
+        pass   # flushes upsert only the dirty rows; nothing to prepare
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+class WriteBehind:
+    """Coalesces record changes and writes them to storage off the event loop.
+
+    A flush hands the records marked dirty since the last one to the storage
+    backend, which snapshots them on the loop and writes in a worker thread.
+    Flushes run every DATA_FLUSH_INTERVAL seconds, or sooner once
+    DATA_FLUSH_THRESHOLD records are dirty.
+    """
+
+    def __init__(self, storage, interval: float, threshold: int, journal: Optional["EconomyJournal"] = None):
+        self.storage   = storage
+        self.journal   = journal
+        self.interval  = interval
+        self.threshold = threshold
+        self.dirty: set[tuple[str, int]] = set()
+        self.flushes   = 0
+        self._wake: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock]  = None
+        self._task: Optional[asyncio.Task]  = None
+        self._stopping = False
+
+    def mark(self, section: str, user_id: int):
+        self.dirty.add((section, user_id))
+        if self._wake and len(self.dirty) >= self.threshold:
+            self._wake.set()
+
+    def _take_batch(self):
+        # Rotate first: if opening the new segment fails, nothing has been taken yet
+        checkpoint = self.journal.rotate() if self.journal else None
+        batch, self.dirty = self.dirty, set()
         try:
-            with open(DATA_FILE, "r") as f:
-                raw = json.load(f)
-            # JSON keys are always strings — convert user IDs back to int
-            user_points   = {int(k): v for k, v in raw.get("user_points", {}).items()}
-            user_stats_raw = raw.get("user_stats", {})
-            user_stats = {}
-            for k, v in user_stats_raw.items():
-                user_stats[int(k)] = {
-                    "commands_used": v["commands_used"],
-                    "last_seen": datetime.fromisoformat(v["last_seen"])
-                }
-            user_personas = {int(k): v for k, v in raw.get("user_personas", {}).items()}
-            daily_claimed = {int(k): v for k, v in raw.get("daily_claimed", {}).items()}
-            return user_points, user_stats, user_personas, daily_claimed
-        except Exception as e:
-            print(f"⚠️  Could not load data.json: {e}. Starting fresh.")
-    return {}, {}, {}, {}
+            return batch, (self.storage.snapshot(batch, user_records), checkpoint)
+        except Exception:
+            self.dirty |= batch
+            if checkpoint:
+                self.journal.seal(checkpoint[1])
+            raise
+
+    def _write(self, payload):
+        snapshot, checkpoint = payload
+        if checkpoint:
+            self.journal.seal(checkpoint[1])
+        self.storage.write(snapshot)
+        if checkpoint:
+            self.journal.mark_covered(checkpoint[0])
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        async with self._lock:
+            with data_flush_seconds.time():
+                try:
+                    batch, payload = self._take_batch()
+                except Exception as e:
+                    print(f"⚠️  Could not save data: {e}")   # the records stay dirty for the next flush
+                    return
+                write = asyncio.ensure_future(asyncio.to_thread(self._write, payload))
+                try:
+                    await asyncio.shield(write)
+                except asyncio.CancelledError:
+                    # The worker thread can't be interrupted: hold the lock until it is done
+                    # so no second writer overlaps it, then let the cancellation through
+                    await asyncio.wait([write])
+                    if write.exception() is not None:
+                        self.dirty |= batch
+                    raise
+                except Exception as e:
+                    self.dirty |= batch   # try these records again on the next flush
+                    print(f"⚠️  Could not save data: {e}")
+                    return
+                self.flushes += 1
+
+    def flush_sync(self):
+        if not self.dirty:
+            return
+        batch, payload = self._take_batch()
+        try:
+            with data_flush_seconds.time():
+                self._write(payload)
+            self.flushes += 1
+        except Exception:
+            self.dirty |= batch
+            raise
+
+    def start(self):
+        if self._task and not self._task.done():
+            return
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            # Let a flush that is already writing finish rather than cancelling it
+            # and racing a second writer against its worker thread
+            self._stopping = True
+            self._wake.set()
+            try:
+                await self._task
+            except Exception as e:
+                print(f"⚠️  Data flusher failed: {e}")
+            self._task = None
+        if self._lock:
+            await self.flush()
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
 
 def save_data():
-    """Persist all in-memory data to disk."""
+    """Synchronously persist pending changes. Only used at shutdown — commands go through persistence.mark()."""
     try:
-        serializable_stats = {
-            str(k): {
-                "commands_used": v["commands_used"],
-                "last_seen": v["last_seen"].isoformat()
-            }
-            for k, v in user_stats.items()
-        }
-        with open(DATA_FILE, "w") as f:
-            json.dump({
-                "user_points":  {str(k): v for k, v in user_points.items()},
-                "user_stats":   serializable_stats,
-                "user_personas": {str(k): v for k, v in user_personas.items()},
-                "daily_claimed": {str(k): v for k, v in daily_claimed.items()},
-            }, f, indent=2)
+        persistence.flush_sync()
     except Exception as e:
-        print(f"⚠️  Could not save data.json: {e}")
+        print(f"⚠️  Could not save data: {e}")
+
+def close_storage():
+    """Final save, then release the storage backends. Called once, as the process exits."""
+    save_data()
+    storage.close()
+    reminder_scheduler.close()
+
+class UserRecords:
+    """Every user's points, stats, persona and daily claim, stored in parallel typed arrays.
+
+    A user ID maps to a row number and each field is an `array` column, so a
+    user costs a few bytes per field instead of a handful of Python objects.
+    Personas are kept as small codes and daily claims as days since the epoch.
+    `section()` wraps one field in a dict-like view, which is what the
+    storage backends and commands use.
+    """
+
+    POINTS, STATS, PERSONA, DAILY = 1, 2, 4, 8   # bits in `present`: which fields a row holds
+    FLAGS = {"user_points": POINTS, "user_stats": STATS, "user_personas": PERSONA, "daily_claimed": DAILY}
+
+    def __init__(self):
+        self._rows: dict[int, int] = {}      # user_id -> row
+        self._ids          = array("q")      # row -> user_id
+        self.present       = array("B")
+        self.points        = array("q")
+        self.commands_used = array("I")
+        self.last_seen     = array("d")      # epoch seconds
+        self.persona       = array("B")      # index into persona_names
+        self.daily         = array("i")      # epoch day of the last /daily claim
+        self.persona_names: list[str] = []   # append-only, so codes never change
+        self._persona_codes: dict[str, int] = {}
+        self._counts = Counter()             # flag -> rows holding it
+
+    @classmethod
+    def from_sections(cls, user_points: dict, user_stats: dict, user_personas: dict, daily_claimed: dict) -> "UserRecords":
+        records = cls()
+        for flag, section in ((cls.POINTS, user_points), (cls.STATS, user_stats),
+                              (cls.PERSONA, user_personas), (cls.DAILY, daily_claimed)):
+            for uid, value in section.items():
+                records.set(flag, uid, value)
+        return records
+
+    def adopt(self, other: "UserRecords"):
+        """Take over other's contents in place, so existing section views see them."""
+        self.__dict__.update(other.__dict__)
+
+    def section(self, flag: int) -> "RecordSection":
+        return RecordSection(self, flag)
+
+    def _row(self, user_id: int) -> int:
+        row = self._rows.get(user_id)
+        if row is None:
+            row = self._rows[user_id] = len(self._ids)
+            self._ids.append(user_id)
+            for column in (self.present, self.points, self.commands_used, self.last_seen, self.persona, self.daily):
+                column.append(0)
+        return row
+
+    def _persona_code(self, name: str) -> int:
+        code = self._persona_codes.get(name)
+        if code is None:
+            code = self._persona_codes[name] = len(self.persona_names)
+            self.persona_names.append(name)
+        return code
+
+    def has(self, flag: int, user_id: int) -> bool:
+        row = self._rows.get(user_id)
+        return row is not None and bool(self.present[row] & flag)
+
+    def get(self, flag: int, user_id: int, default=None):
+        row = self._rows.get(user_id)
+        if row is None or not self.present[row] & flag:
+            return default
+        if flag == self.POINTS:
+            return self.points[row]
+        if flag == self.STATS:
+            return {"commands_used": self.commands_used[row], "last_seen": datetime.fromtimestamp(self.last_seen[row])}
+        if flag == self.PERSONA:
+            return self.persona_names[self.persona[row]]
+        return (EPOCH + timedelta(days=self.daily[row])).isoformat()
+
+    def set(self, flag: int, user_id: int, value):
+        row = self._row(user_id)
+        if flag == self.POINTS:
+            self.points[row] = value
+        elif flag == self.STATS:
+            self.commands_used[row] = value["commands_used"]
+            self.last_seen[row] = value["last_seen"].timestamp()
+        elif flag == self.PERSONA:
+            self.persona[row] = self._persona_code(value)
+        else:
+            self.daily[row] = (date.fromisoformat(value) - EPOCH).days
+        if not self.present[row] & flag:
+            self.present[row] |= flag
+            self._counts[flag] += 1
+
+    def discard(self, flag: int, user_id: int) -> bool:
+        row = self._rows.get(user_id)
+        if row is None or not self.present[row] & flag:
+            return False
+        self.present[row] &= ~flag
+        self._counts[flag] -= 1
+        return True
+
+    def touch(self, user_id: int):
+        """Count one command for user_id and stamp last_seen."""
+        row = self._row(user_id)
+        if not self.present[row] & self.STATS:
+            self.present[row] |= self.STATS
+            self._counts[self.STATS] += 1
+            self.commands_used[row] = 0
+        self.commands_used[row] += 1
+        self.last_seen[row] = time.time()
+
+    def count(self, flag: int) -> int:
+        return self._counts[flag]
+
+    def columns(self) -> list[array]:
+        """Copies of every column: user_id, present, points, commands_used, last_seen, persona, daily."""
+        return [self._ids[:], self.present[:], self.points[:], self.commands_used[:],
+                self.last_seen[:], self.persona[:], self.daily[:]]
+
+    def rows(self, user_ids) -> list[tuple]:
+        """(row, *one value per column) for each user, as plain numbers another thread can own."""
+        out = []
+        for uid in user_ids:
+            row = self._rows[uid]
+            out.append((row, uid, self.present[row], self.points[row], self.commands_used[row],
+                        self.last_seen[row], self.persona[row], self.daily[row]))
+        return out
+
+    def ids(self, flag: int):
+        return (uid for uid, bits in zip(self._ids, self.present) if bits & flag)
+
+class RecordSection(MutableMapping):
+    """Dict-like view of one UserRecords field, keyed by user ID."""
+
+    def __init__(self, records: UserRecords, flag: int):
+        self.records = records
+        self.flag    = flag
+
+    def __getitem__(self, user_id: int):
+        value = self.records.get(self.flag, user_id, _MISSING)
+        if value is _MISSING:
+            raise KeyError(user_id)
+        return value
+
+    def get(self, user_id: int, default=None):
+        return self.records.get(self.flag, user_id, default)
+
+    def __setitem__(self, user_id: int, value):
+        self.records.set(self.flag, user_id, value)
+
+    def __delitem__(self, user_id: int):
+        if not self.records.discard(self.flag, user_id):
+            raise KeyError(user_id)
+
+    def __contains__(self, user_id) -> bool:
+        return self.records.has(self.flag, user_id)
+
+    def __iter__(self):
+        return self.records.ids(self.flag)
+
+    def __len__(self) -> int:
+        return self.records.count(self.flag)
+
+# ============== ECONOMY JOURNAL ==================
+# Every points change is also appended to a JSON-lines journal, one line per
+# event with the balances it produced, so replaying a line twice is harmless.
+# Each write-behind flush doubles as a snapshot: the journal rotates to a new
+# segment, and once the storage write lands the older segments are marked as
+# covered. Startup replays only uncovered segments on top of what storage
+# loaded. Covered segments stay around as an audit trail for
+# JOURNAL_RETENTION_DAYS before the background compactor deletes them.
+
+JOURNAL_DIR             = os.getenv("JOURNAL_DIR", f"journal{SHARD_FILE_SUFFIX}")
+JOURNAL_SYNC_INTERVAL   = float(os.getenv("JOURNAL_SYNC_INTERVAL", "1"))       # seconds between fsyncs
+JOURNAL_RETENTION_DAYS  = float(os.getenv("JOURNAL_RETENTION_DAYS", "7"))      # how long covered segments are kept
+JOURNAL_COMPACT_INTERVAL = 3600   # seconds between compaction passes
+
+class EconomyJournal:
+    def __init__(self, directory: str, sync_interval: float, retention_days: float):
+        self.directory      = directory
+        self.sync_interval  = sync_interval
+        self.retention      = retention_days * 86400
+        self.segment        = 0   # segment being appended to
+        self.covered        = 0   # segments below this one are in the last snapshot
+        self.appended       = 0
+        self.compacted      = 0
+        self._file          = None
+        self._segment_empty = True
+        self._unsynced      = False
+        self._task: Optional[asyncio.Task] = None
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"economy-{segment:08d}.jsonl")
+
+    def _marker(self) -> str:
+        return os.path.join(self.directory, "snapshot.json")
+
+    def _segments(self) -> list[int]:
+        return sorted(
+            int(name[8:-6]) for name in os.listdir(self.directory)
+            if name.startswith("economy-") and name.endswith(".jsonl")
+        )
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self._marker(), "r") as f:
+                self.covered = json.load(f)["segment"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️  Could not read {self._marker()}: {e}. Replaying the whole journal.")
+        segments = self._segments()
+        # Always start a fresh segment, so a line torn by a crash never has new events after it
+        self.segment = max(segments[-1] + 1 if segments else 0, self.covered)
+        self._file = open(self._path(self.segment), "ab", buffering=0)
+
+    def replay(self, apply) -> int:
+        """Pass every event newer than the last snapshot to apply(event). Returns how many."""
+        count = 0
+        for segment in self._segments():
+            if segment < self.covered or segment == self.segment:
+                continue
+            with open(self._path(segment), "rb") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        break   # torn last line of a segment we crashed in
+                    apply(event)
+                    count += 1
+        return count
+
+    def append(self, op: str, **fields):
+        """Record one economy event. A single unbuffered write, so a process crash loses nothing."""
+        if self._file is None:
+            return
+        event = {"ts": round(time.time(), 3), "op": op, **fields}
+        self._file.write(json.dumps(event, separators=(",", ":")).encode() + b"\n")
+        self._segment_empty = False
+        self._unsynced = True
+        self.appended += 1
+
+    def rotate(self):
+        """Close the segment a snapshot is about to cover. Returns (first uncovered segment, closed file or None).
+
+        Called on the event loop in the same step the snapshot is taken, so the
+        snapshot holds exactly the events in the segments before the checkpoint.
+        """
+        if self._file is None or self._segment_empty:
+            return self.segment, None
+        new = open(self._path(self.segment + 1), "ab", buffering=0)
+        sealed, self._file = self._file, new
+        self.segment += 1
+        self._segment_empty = True
+        return self.segment, sealed
+
+    def seal(self, sealed):
+        """fsync and close a rotated-out segment. Runs in the flusher's worker thread."""
+        if sealed is not None:
+            os.fsync(sealed.fileno())
+            sealed.close()
+
+    def mark_covered(self, checkpoint: int):
+        """Record that storage now holds every event before segment `checkpoint`."""
+        if checkpoint <= self.covered:
+            return
+        _write_json_atomic(self._marker(), {"segment": checkpoint})
+        self.covered = checkpoint
+
+    def _sync(self):
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def _compact(self) -> int:
+        cutoff = time.time() - self.retention
+        removed = 0
+        for segment in self._segments():
+            if segment >= self.covered:
+                break
+            path = self._path(segment)
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        return removed
+
+    def start(self):
+        if self._file is None or (self._task and not self._task.done()):
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        if self._unsynced:
+            self._unsynced = False
+            await asyncio.to_thread(self._sync)
+
+    async def _run(self):
+        next_compact = time.monotonic()
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                if self._unsynced:
+                    self._unsynced = False
+                    await asyncio.to_thread(self._sync)
+                if time.monotonic() >= next_compact:
+                    next_compact = time.monotonic() + JOURNAL_COMPACT_INTERVAL
+                    self.compacted += await asyncio.to_thread(self._compact)
+            except Exception as e:
+                print(f"⚠️  Journal maintenance failed: {e}")
+
+def apply_economy_event(records: "UserRecords", event: dict, dirty: set):
+    """Replay one journal event into records: set the balances (and daily claim) it recorded."""
+    op = event["op"]
+    if op == "transfer":
+        balances = {event["from"]: event["balance"][0], event["to"]: event["balance"][1]}
+    else:
+        balances = {event["user_id"]: event["balance"]}
+    for uid, pts in balances.items():
+        records.set(UserRecords.POINTS, uid, pts)
+        dirty.add(("user_points", uid))
+    if op == "daily":
+        records.set(UserRecords.DAILY, event["user_id"], event["day"])
+        dirty.add(("daily_claimed", event["user_id"]))
+
+# Opening storage is cheap; the records themselves are read by load_user_data() once the bot starts
+if STORAGE_BACKEND == "sqlite":
+    storage = SqliteStorage(DB_FILE, DATA_FILE)
+else:
+    storage = JsonStorage(DATA_FILE)
+user_records  = UserRecords()
+user_points   = user_records.section(UserRecords.POINTS)
+user_stats    = user_records.section(UserRecords.STATS)
+user_personas = user_records.section(UserRecords.PERSONA)
+daily_claimed = user_records.section(UserRecords.DAILY)
+economy_journal = EconomyJournal(JOURNAL_DIR, JOURNAL_SYNC_INTERVAL, JOURNAL_RETENTION_DAYS)
+economy_journal.open()
+persistence = WriteBehind(storage, DATA_FLUSH_INTERVAL, DATA_FLUSH_THRESHOLD, economy_journal)
+
+# ============== LEADERBOARD INDEX ==================
+
+class RankedIndex:
+    """Point holders kept sorted by (-points, user_id), updated as points change.
+
+    Top-N is a slice and a user's rank is two binary searches, so /leaderboard
+    and /points never sort the whole economy. Ties are broken by user ID. The
+    keys live in two parallel int arrays, 16 bytes per holder.
+    """
+
+    def __init__(self, points):
+        self.rebuild(points)
+
+    def rebuild(self, points):
+        keys = sorted((-pts, uid) for uid, pts in points.items())
+        self._neg  = array("q", (neg for neg, _ in keys))   # -points, ascending
+        self._uids = array("q", (uid for _, uid in keys))   # user_id, ascending within equal points
+
+    def __len__(self):
+        return len(self._neg)
+
+    def _find(self, user_id: int, points: int) -> int:
+        lo = bisect.bisect_left(self._neg, -points)
+        hi = bisect.bisect_right(self._neg, -points, lo)
+        return bisect.bisect_left(self._uids, user_id, lo, hi)
+
+    def update(self, user_id: int, old: Optional[int], points: int):
+        """Move user_id from `old` points (None if they had none) to `points`."""
+        if old == points:
+            return
+        if old is not None:
+            i = self._find(user_id, old)
+            del self._neg[i], self._uids[i]
+        i = self._find(user_id, points)
+        self._neg.insert(i, -points)
+        self._uids.insert(i, user_id)
+
+    def top(self, limit: int) -> list[tuple[int, int]]:
+        return [(uid, -neg) for neg, uid in zip(self._neg[:limit], self._uids[:limit])]
 
-# Load at startup
-user_points, user_stats, user_personas, daily_claimed = load_data()
+    def rank(self, user_id: int, points: int) -> int:
+        """1-based position of user_id, who currently holds `points`."""
+        return self._find(user_id, points) + 1
+
+leaderboard_index = RankedIndex(user_points)
 
 active_trivia = {}   # {guild_id: {answer, category}}
-reminders     = []   # [{user_id, channel_id, message, time}]
+
+# ============== REMINDERS ==================
+# Pending reminders sit in a min-heap ordered by due time. The scheduler
+# sleeps until the earliest one is due (or a sooner one is added). Each
+# reminder is also a row in reminders.db: adds and deliveries are queued as
+# single-row inserts and deletes and written in batches, so a change costs
+# the same however many reminders are pending.
+
+REMINDERS_FILE        = f"reminders{SHARD_FILE_SUFFIX}.db"
+REMINDERS_LEGACY_FILE = f"reminders{SHARD_FILE_SUFFIX}.json"   # migrated into REMINDERS_FILE once
+REMINDER_CONCURRENCY  = int(os.getenv("REMINDER_CONCURRENCY", "10"))   # reminders delivered at once
+REMINDER_SAVE_DELAY   = 1.0   # seconds to batch heap changes before saving
+
+class ReminderScheduler:
+    def __init__(self, path: str, legacy_json: str, concurrency: int):
+        self.path        = path
+        self.legacy_json = legacy_json
+        self.concurrency = concurrency
+        self.delivered   = 0
+        self._heap: list[tuple[float, int, dict]] = []   # (due epoch, id, {id, user_id, channel_id, message, due})
+        self._ids        = itertools.count(1)
+        self._ops: list[tuple[str, dict]] = []           # ("add" | "done", reminder) not written yet
+        self._deliver    = None
+        self._wake: Optional[asyncio.Event]     = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task]      = None
+        self._save_task: Optional[asyncio.Task] = None
+        self._sending: set[asyncio.Task] = set()         # due reminders being (or waiting to be) delivered
+        self._lock = threading.Lock()   # saves run in worker threads
+        self.conn  = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS reminders (
+                id         INTEGER PRIMARY KEY,
+                user_id    INTEGER NOT NULL,
+                channel_id INTEGER NOT NULL,
+                message    TEXT NOT NULL,
+                due        REAL NOT NULL
+            )
+        """)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _migrate(self):
+        if not os.path.exists(self.legacy_json):
+            return
+        try:
+            with open(self.legacy_json, "r") as f:
+                pending = json.load(f)
+            self._write([("add", dict(r, id=None)) for r in pending])
+            os.replace(self.legacy_json, f"{self.legacy_json}.migrated")
+            print(f"📦 Migrated {len(pending)} reminders from {self.legacy_json} to {self.path}")
+        except Exception as e:
+            print(f"⚠️  Could not migrate {self.legacy_json}: {e}")
+
+    def load(self):
+        self._migrate()
+        try:
+            rows = self.conn.execute("SELECT id, user_id, channel_id, message, due FROM reminders").fetchall()
+        except Exception as e:
+            print(f"⚠️  Could not load {self.path}: {e}")
+            return
+        self._heap = [
+            (due, rid, {"id": rid, "user_id": uid, "channel_id": cid, "message": msg, "due": due})
+            for rid, uid, cid, msg, due in rows
+        ]
+        heapq.heapify(self._heap)
+        self._ids = itertools.count(max((rid for _, rid, _ in self._heap), default=0) + 1)
+
+    def _write(self, ops: list[tuple[str, dict]]):
+        # Both statements are idempotent, so a batch that is retried after a failure is harmless
+        added = [(r["id"], r["user_id"], r["channel_id"], r["message"], r["due"]) for op, r in ops if op == "add"]
+        done  = [(r["id"],) for op, r in ops if op == "done"]
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO reminders (id, user_id, channel_id, message, due) VALUES (?, ?, ?, ?, ?)",
+                    added
+                )
+                self.conn.executemany("DELETE FROM reminders WHERE id = ?", done)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    async def save(self):
+        ops, self._ops = self._ops, []
+        if not ops:
+            return
+        try:
+            await asyncio.to_thread(self._write, ops)
+        except BaseException as e:
+            self._ops = ops + self._ops   # written again on the next save
+            if not isinstance(e, Exception):
+                raise
+            print(f"⚠️  Could not save {self.path}: {e}")
+
+    def _save_soon(self):
+        if self._save_task and not self._save_task.done():
+            return
+        self._save_task = asyncio.create_task(self._save_later())
+
+    async def _save_later(self):
+        await asyncio.sleep(REMINDER_SAVE_DELAY)
+        await self.save()
+
+    def add(self, user_id: int, channel_id: int, message: str, due: float):
+        reminder = {"id": next(self._ids), "user_id": user_id, "channel_id": channel_id, "message": message, "due": due}
+        heapq.heappush(self._heap, (due, reminder["id"], reminder))
+        if self._wake and self._heap[0][2] is reminder:
+            self._wake.set()   # new earliest deadline
+        self._ops.append(("add", reminder))
+        self._save_soon()
+
+    def start(self, deliver):
+        """Begin delivering with `deliver(reminder)`. Safe to call again on reconnect."""
+        self._deliver = deliver
+        if self._task and not self._task.done():
+            return
+        self._wake  = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._task  = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        # Undelivered reminders go back on the heap and stay in the database
+        sending = list(self._sending)
+        for task in sending:
+            task.cancel()
+        await asyncio.gather(*sending, return_exceptions=True)
+        if self._save_task:
+            self._save_task.cancel()
+            self._save_task = None
+        await self.save()
+
+    def close(self):
+        """Write anything still queued and close the database. Called once, as the process exits."""
+        ops, self._ops = self._ops, []
+        try:
+            if ops:
+                self._write(ops)
+        except Exception as e:
+            print(f"⚠️  Could not save {self.path}: {e}")
+        with self._lock:
+            self.conn.close()
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            delay = self._heap[0][0] - time.time() if self._heap else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = time.time()
+            while self._heap and self._heap[0][0] <= now:
+                _, _, reminder = heapq.heappop(self._heap)
+                task = asyncio.create_task(self._send(reminder))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+
+    async def _send(self, reminder: dict):
+        try:
+            async with self._slots:
+                try:
+                    await self._deliver(reminder)
+                    self.delivered += 1
+                except Exception as e:
+                    print(f"Error sending reminder: {e}")
+        except asyncio.CancelledError:
+            heapq.heappush(self._heap, (reminder["due"], reminder["id"], reminder))
+            raise
+        # Only now is the row deleted, so a reminder still queued when the process dies is sent after restart
+        self._ops.append(("done", reminder))
+        self._save_soon()
+
+reminder_scheduler = ReminderScheduler(REMINDERS_FILE, REMINDERS_LEGACY_FILE, REMINDER_CONCURRENCY)
+
+# ============== VIEW STATE =================
+# Trivia rounds and polls keep their state here, keyed by message ID, and
+# it's saved to views.json. On startup every saved view is re-registered
+# with bot.add_view so its buttons keep working across restarts.
+
+VIEWS_FILE         = f"views{SHARD_FILE_SUFFIX}.json"
+VIEW_SAVE_DELAY    = 1.0   # seconds to batch vote changes before saving
+POLL_EDIT_INTERVAL = float(os.getenv("POLL_EDIT_INTERVAL", "2.0"))   # min seconds between poll embed edits
+POLL_REFRESH_RETRIES = 5   # failed edits retried (with backoff) before waiting for the next vote
+
+poll_edits = Counter()   # {"requested": votes that needed a refresh, "sent": edits actually made}
+
+class ViewStates:
+    def __init__(self, path: str):
+        self.path   = path
+        self.states: dict[int, dict] = {}   # message_id -> {kind, token, channel_id, expires, ...}
+        self._unsaved   = False
+        self._save_task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self.states)
+
+    def count(self, kind: str) -> int:
+        return sum(1 for s in self.states.values() if s["kind"] == kind)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                raw = json.load(f)
+            for mid, state in raw.items():
+                if state["kind"] == "poll":
+                    state["votes"] = {int(uid): idx for uid, idx in state["votes"].items()}
+                self.states[int(mid)] = state
+        except Exception as e:
+            print(f"⚠️  Could not load {self.path}: {e}")
+
+    def _snapshot(self) -> dict:
+        # Votes and wrong guesses change in place, so copy them for the writer thread
+        return {
+            str(mid): {k: v.copy() if isinstance(v, (list, dict)) else v for k, v in state.items()}
+            for mid, state in self.states.items()
+        }
+
+    async def save(self):
+        self._unsaved = False
+        try:
+            await asyncio.to_thread(_write_json_atomic, self.path, self._snapshot())
+        except Exception as e:
+            self._unsaved = True
+            print(f"⚠️  Could not save {self.path}: {e}")
+
+    def changed(self):
+        self._unsaved = True
+        if self._save_task and not self._save_task.done():
+            return
+        self._save_task = asyncio.create_task(self._save_later())
+
+    async def _save_later(self):
+        await asyncio.sleep(VIEW_SAVE_DELAY)
+        await self.save()
+
+    def put(self, message_id: int, state: dict):
+        self.states[message_id] = state
+        self.changed()
+
+    def drop(self, message_id: int):
+        if self.states.pop(message_id, None) is not None:
+            self.changed()
+
+    async def stop(self):
+        if self._save_task:
+            self._save_task.cancel()
+            self._save_task = None
+        if self._unsaved:   # never rewrite the file from states that weren't loaded yet
+            await self.save()
+
+view_states = ViewStates(VIEWS_FILE)
 
 # ============== PERSONAS =================
 
@@ -120,15 +1077,100 @@ PERSONAS = {
     )
 }
 
-def get_system_prompt(user_id: int) -> str:
+def get_persona_key(user_id: int) -> str:
     persona_key = user_personas.get(user_id, "default")
-    return PERSONAS.get(persona_key, PERSONAS["default"])
+    return persona_key if persona_key in PERSONAS else "default"
 
 # ============== FILTERS ==================
 
 BAD_WORDS = ["fuck", "shit", "idiot", "bitch", "hurensohn", "arschloch"]
 INAPPROPRIATE_PHRASES = ["sex", "naked", "fetish"]
 
+FILTERS_FILE = f"filters{SHARD_FILE_SUFFIX}.json"   # per-guild extra words: {guild_id: {category: [words]}}
+FILTER_CATEGORIES = ("toxic", "inappropriate")   # highest priority first
+
+class ModerationFilter:
+    """Compiles every word list into one regex per guild so a message is scanned once.
+
+    Each category is a named group, so a match says which list it came from.
+    Words match at the start of a word: "fucking" is caught, "Sussex" is not.
+    Guilds without extra words share the compiled base pattern.
+    """
+
+    def __init__(self, base: dict[str, list[str]], path: str, fallback: Optional[str] = None):
+        self.base = base
+        self.path = path
+        self.fallback = fallback   # read until this process has saved its own file
+        self.guild_words: dict[int, dict[str, set[str]]] = {}
+        self._compiled: dict[Optional[int], re.Pattern] = {}
+
+    def load(self):
+        path = self.path if os.path.exists(self.path) else self.fallback
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, "r") as f:
+                raw = json.load(f)
+            self.guild_words = {
+                int(gid): {cat: set(words) for cat, words in lists.items() if cat in FILTER_CATEGORIES}
+                for gid, lists in raw.items()
+            }
+            self._compiled.clear()
+        except Exception as e:
+            print(f"⚠️  Could not load {self.path}: {e}")
+
+    def save(self):
+        _write_json_atomic(self.path, {
+            str(gid): {cat: sorted(words) for cat, words in lists.items()}
+            for gid, lists in self.guild_words.items()
+        })
+
+    def _build(self, guild_id: Optional[int]) -> re.Pattern:
+        extra = self.guild_words.get(guild_id, {})
+        groups = []
+        for cat in FILTER_CATEGORIES:
+            words = set(self.base.get(cat, [])) | extra.get(cat, set())
+            if words:
+                # Longest first so a longer phrase wins over its own prefix
+                alts = "|".join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+                groups.append(f"(?P<{cat}>(?<!\\w)(?:{alts}))")
+        return re.compile("|".join(groups) or "(?!)", re.IGNORECASE)
+
+    def _pattern(self, guild_id: Optional[int]) -> re.Pattern:
+        key = guild_id if guild_id in self.guild_words else None
+        pattern = self._compiled.get(key)
+        if pattern is None:
+            pattern = self._compiled[key] = self._build(key)
+        return pattern
+
+    def check(self, text: str, guild_id: Optional[int] = None) -> Optional[str]:
+        """Return the highest-priority category matched in text, or None."""
+        found = None
+        for m in self._pattern(guild_id).finditer(text):
+            if m.lastgroup == FILTER_CATEGORIES[0]:
+                return m.lastgroup
+            found = m.lastgroup
+        return found
+
+    def words(self, guild_id: int, category: str) -> set[str]:
+        return self.guild_words.get(guild_id, {}).get(category, set())
+
+    def add_word(self, guild_id: int, category: str, word: str):
+        self.guild_words.setdefault(guild_id, {}).setdefault(category, set()).add(word.lower())
+        self._compiled.pop(guild_id, None)
+        self.save()
+
+    def remove_word(self, guild_id: int, category: str, word: str) -> bool:
+        words = self.words(guild_id, category)
+        if word.lower() not in words:
+            return False
+        words.discard(word.lower())
+        self._compiled.pop(guild_id, None)
+        self.save()
+        return True
+
+moderation = ModerationFilter({"toxic": BAD_WORDS, "inappropriate": INAPPROPRIATE_PHRASES}, FILTERS_FILE, "filters.json")
+
 ROASTS = [
     "{target}, you just might be why the middle finger was invented.",
     "{target}, if I were on a deserted island with you and a tin of corned beef, I'd rather eat you and talk to the corned beef.",
@@ -153,217 +1195,1504 @@ COMPLIMENTS = [
     "{target}, you're proof that good people exist! 💙"
 ]
 
-# ========== HELPER FUNCTIONS ==============
+# ============== MESSAGE FAST PATH ==================
+# Almost all traffic is ordinary chat. on_message drops anything that neither
+# starts with PREFIX nor matches a trigger word (one pass of a compiled
+# regex) before doing any other work, and counts how far each message got.
+
+TRIGGERS = ['.joke', '.roast', '.trivia', '.meme']
+TRIGGER_PATTERN = re.compile("|".join(re.escape(t) for t in TRIGGERS), re.IGNORECASE)
+GUILD_SETTINGS_FILE = f"guild_settings{SHARD_FILE_SUFFIX}.json"
+
+message_counters = Counter()   # stage -> messages that reached it (plain, reacted, empty, toxic, ai, ...)
+
+class GuildSettings:
+    """Small per-guild switches, saved to guild_settings.json."""
+
+    def __init__(self, path: str, fallback: Optional[str] = None):
+        self.path = path
+        self.fallback = fallback   # read until this process has saved its own file
+        self.settings: dict[int, dict] = {}
+
+    def load(self):
+        path = self.path if os.path.exists(self.path) else self.fallback
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, "r") as f:
+                self.settings = {int(gid): v for gid, v in json.load(f).items()}
+        except Exception as e:
+            print(f"⚠️  Could not load {self.path}: {e}")
+
+    def save(self):
+        _write_json_atomic(self.path, {str(gid): v for gid, v in self.settings.items()})
 
-def is_toxic(text):
-    return any(w in text.lower() for w in BAD_WORDS)
+    def trigger_reactions(self, guild_id: Optional[int]) -> bool:
+        return self.settings.get(guild_id, {}).get("trigger_reactions", True)
 
-def is_inappropriate(text):
-    return any(p in text.lower() for p in INAPPROPRIATE_PHRASES)
+    def set_trigger_reactions(self, guild_id: int, enabled: bool):
+        self.settings.setdefault(guild_id, {})["trigger_reactions"] = enabled
+        self.save()
+
+guild_settings = GuildSettings(GUILD_SETTINGS_FILE, "guild_settings.json")
+
+# ========== HELPER FUNCTIONS ==============
+
+FORBIDDEN_MARKERS = ["user:", "assistant:", "bot:"]
 
 def clean_output(text: str) -> str:
     if not text:
         return ""
     text = text.split("\n")[0]
-    for forbidden in ["user:", "assistant:", "bot:"]:
+    for forbidden in FORBIDDEN_MARKERS:
         if forbidden in text.lower():
             text = text.lower().split(forbidden)[0]
     return text.strip()
 
 def add_points(user_id: int, points: int = 1):
-    user_points[user_id] = user_points.get(user_id, 0) + points
-    save_data()
+    set_points(user_id, user_points.get(user_id, 0) + points)
+
+def set_points(user_id: int, points: int):
+    leaderboard_index.update(user_id, user_points.get(user_id), points)
+    user_points[user_id] = points
+    persistence.mark("user_points", user_id)
 
 def get_points(user_id: int) -> int:
     return user_points.get(user_id, 0)
 
 def track_user_activity(user_id: int):
-    if user_id not in user_stats:
-        user_stats[user_id] = {"commands_used": 0, "last_seen": datetime.now()}
-    user_stats[user_id]["commands_used"] += 1
-    user_stats[user_id]["last_seen"] = datetime.now()
-    save_data()
+    user_records.touch(user_id)
+    persistence.mark("user_stats", user_id)
+
+# ============== STATE STORE ==================
+# Commands change the points economy only through `state_store`, so the same
+# code runs against this process's memory (STATE_STORE=local, the default) or
+# an SQLite file every bot process shares (STATE_STORE=shared). Each operation
+# is atomic: a check and the update it guards can never interleave with
+# another command, in this process or another one.
+
+STATE_STORE       = os.getenv("STATE_STORE", "local").lower()   # "local" or "shared"
+SHARED_STATE_FILE = os.getenv("SHARED_STATE_FILE", "shared_state.db")
+
+class InsufficientPoints(Exception):
+    def __init__(self, user_id: int, balance: int):
+        super().__init__(f"user {user_id} only has {balance} points")
+        self.user_id = user_id
+        self.balance = balance
+
+class LocalStateStore:
+    """The in-memory maps, persisted by the write-behind flusher.
+
+    Nothing here awaits, so every operation runs to completion on the event
+    loop without interleaving.
+    """
+
+    async def get_points(self, user_id: int) -> int:
+        return get_points(user_id)
+
+    async def add_points(self, user_id: int, amount: int, reason: str = "add") -> int:
+        add_points(user_id, amount)
+        balance = get_points(user_id)
+        economy_journal.append("add", reason=reason, user_id=user_id, amount=amount, balance=balance)
+        return balance
+
+    async def transfer(self, sender_id: int, receiver_id: int, amount: int, receiver_min: int = 0,
+                       reason: str = "give") -> tuple[int, int]:
+        """Move points, raising InsufficientPoints if the sender has less than amount
+        or the receiver less than receiver_min. Returns both new balances."""
+        sender_pts, receiver_pts = get_points(sender_id), get_points(receiver_id)
+        if sender_pts < amount:
+            raise InsufficientPoints(sender_id, sender_pts)
+        if receiver_pts < receiver_min:
+            raise InsufficientPoints(receiver_id, receiver_pts)
+        set_points(sender_id, sender_pts - amount)
+        set_points(receiver_id, receiver_pts + amount)
+        balances = [sender_pts - amount, receiver_pts + amount]
+        economy_journal.append("transfer", reason=reason, amount=amount, balance=balances,
+                               **{"from": sender_id, "to": receiver_id})
+        return balances[0], balances[1]
+
+    async def claim_daily(self, user_id: int, day: str, bonus: int) -> Optional[int]:
+        """Grant bonus once per day. Returns the new balance, or None if already claimed."""
+        if daily_claimed.get(user_id) == day:
+            return None
+        daily_claimed[user_id] = day
+        persistence.mark("daily_claimed", user_id)
+        add_points(user_id, bonus)
+        balance = get_points(user_id)
+        economy_journal.append("daily", user_id=user_id, day=day, amount=bonus, balance=balance)
+        return balance
+
+    async def top(self, limit: int) -> list[tuple[int, int]]:
+        return leaderboard_index.top(limit)
+
+    async def rank(self, user_id: int) -> Optional[tuple[int, int]]:
+        """(1-based rank, number of point holders), or None if the user has never held points."""
+        points = user_points.get(user_id)
+        if points is None:
+            return None
+        return leaderboard_index.rank(user_id, points), len(leaderboard_index)
+
+class SharedStateStore:
+    """Points and daily claims in an SQLite file shared by every bot process.
+
+    Each operation is one BEGIN IMMEDIATE transaction, so SQLite's file lock
+    serializes it against other processes. Calls run in worker threads, each
+    with its own connection.
+    """
+
+    def __init__(self, path: str):
+        self.path   = path
+        self._local = threading.local()
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS economy (
+                user_id       INTEGER PRIMARY KEY,
+                points        INTEGER NOT NULL DEFAULT 0,
+                daily_claimed TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_economy_points ON economy(points);
+        """)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _txn(self, fn):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _points(conn: sqlite3.Connection, user_id: int) -> int:
+        row = conn.execute("SELECT points FROM economy WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def _set_points(conn: sqlite3.Connection, user_id: int, points: int):
+        conn.execute(
+            "INSERT INTO economy (user_id, points) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET points = excluded.points",
+            (user_id, points)
+        )
+
+    def seed(self, points: dict[int, int], claimed: dict[int, str]):
+        """Copy this process's data in if the shared table is still empty."""
+        def run(conn):
+            if conn.execute("SELECT 1 FROM economy LIMIT 1").fetchone():
+                return
+            conn.executemany(
+                "INSERT INTO economy (user_id, points, daily_claimed) VALUES (?, ?, ?)",
+                [(uid, points.get(uid, 0), claimed.get(uid)) for uid in points.keys() | claimed.keys()]
+            )
+        self._txn(run)
+
+    async def get_points(self, user_id: int) -> int:
+        return await asyncio.to_thread(lambda: self._points(self._conn(), user_id))
+
+    async def add_points(self, user_id: int, amount: int, reason: str = "add") -> int:
+        def run(conn):
+            new = self._points(conn, user_id) + amount
+            self._set_points(conn, user_id, new)
+            return new
+        return await asyncio.to_thread(self._txn, run)
+
+    async def transfer(self, sender_id: int, receiver_id: int, amount: int, receiver_min: int = 0,
+                       reason: str = "give") -> tuple[int, int]:
+        # `reason` only labels journal entries; the shared table is durable on its own
+        def run(conn):
+            sender_pts, receiver_pts = self._points(conn, sender_id), self._points(conn, receiver_id)
+            if sender_pts < amount:
+                raise InsufficientPoints(sender_id, sender_pts)
+            if receiver_pts < receiver_min:
+                raise InsufficientPoints(receiver_id, receiver_pts)
+            self._set_points(conn, sender_id, sender_pts - amount)
+            self._set_points(conn, receiver_id, receiver_pts + amount)
+            return sender_pts - amount, receiver_pts + amount
+        return await asyncio.to_thread(self._txn, run)
+
+    async def claim_daily(self, user_id: int, day: str, bonus: int) -> Optional[int]:
+        def run(conn):
+            row = conn.execute("SELECT points, daily_claimed FROM economy WHERE user_id = ?", (user_id,)).fetchone()
+            if row and row[1] == day:
+                return None
+            new = (row[0] if row else 0) + bonus
+            conn.execute(
+                "INSERT INTO economy (user_id, points, daily_claimed) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET points = excluded.points, daily_claimed = excluded.daily_claimed",
+                (user_id, new, day)
+            )
+            return new
+        return await asyncio.to_thread(self._txn, run)
+
+    async def top(self, limit: int) -> list[tuple[int, int]]:
+        return await asyncio.to_thread(lambda: self._conn().execute(
+            "SELECT user_id, points FROM economy ORDER BY points DESC, user_id LIMIT ?", (limit,)
+        ).fetchall())
+
+    async def rank(self, user_id: int) -> Optional[tuple[int, int]]:
+        def run():
+            conn = self._conn()
+            row = conn.execute("SELECT points FROM economy WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                return None
+            ahead = conn.execute(
+                "SELECT COUNT(*) FROM economy WHERE points > ? OR (points = ? AND user_id < ?)",
+                (row[0], row[0], user_id)
+            ).fetchone()[0]
+            total = conn.execute("SELECT COUNT(*) FROM economy").fetchone()[0]
+            return ahead + 1, total
+        return await asyncio.to_thread(run)
+
+if STATE_STORE == "shared":
+    state_store = SharedStateStore(SHARED_STATE_FILE)
+else:
+    state_store = LocalStateStore()
 
 # ========== API FUNCTIONS =================
+# All helpers share one pooled session so repeat calls reuse warm keep-alive
+# connections instead of paying a TCP+TLS handshake per command.
+
+HTTP_POOL_SIZE     = int(os.getenv("HTTP_POOL_SIZE", "100"))      # total open connections
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "10"))   # connections per API host
+HTTP_TIMEOUT       = aiohttp.ClientTimeout(total=5)
+
+http_session: Optional[aiohttp.ClientSession] = None
+
+async def open_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            ttl_dns_cache=300,
+            keepalive_timeout=60
+        )
+        http_session = aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT)
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+async def fetch_json(url: str):
+    session = await open_http_session()
+    api = urlsplit(url).hostname   # one API per host, so this labels latency and errors per helper
+    with api_seconds.time(api):
+        try:
+            async with session.get(url) as resp:
+                return await resp.json()
+        except Exception:
+            api_errors[api] += 1
+            raise
+
+# ---- Prefetch buffers ----
+# A background task keeps a queue of ready items per content type, pulled in
+# batches where the API allows it. Helpers pop from the queue and only fall
+# back to a live request when it is empty.
+
+CONTENT_BUFFER_SIZE     = int(os.getenv("CONTENT_BUFFER_SIZE", "50"))
+CONTENT_REFILL_INTERVAL = float(os.getenv("CONTENT_REFILL_INTERVAL", "60"))   # seconds between idle checks
+
+class ContentBuffer:
+    def __init__(self, fetch_batch, size: int):
+        self.fetch_batch = fetch_batch
+        self.items  = deque(maxlen=size)
+        self.hits   = 0
+        self.misses = 0
+
+    def low(self) -> bool:
+        return len(self.items) <= self.items.maxlen // 2
+
+    async def refill(self):
+        try:
+            batch = await self.fetch_batch()
+        except Exception:
+            return
+        space = self.items.maxlen - len(self.items)
+        self.items.extend(batch[:space])
+
+class ContentPrefetcher:
+    def __init__(self, size: int, interval: float):
+        self.size     = size
+        self.interval = interval
+        self.buffers: dict[str, ContentBuffer] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task]  = None
+
+    def register(self, name: str, fetch_batch):
+        self.buffers[name] = ContentBuffer(fetch_batch, self.size)
+
+    def pop(self, name: str):
+        buf = self.buffers[name]
+        item = buf.items.popleft() if buf.items else None
+        if item is None:
+            buf.misses += 1
+        else:
+            buf.hits += 1
+        if buf.low() and self._wake:
+            self._wake.set()
+        return item
+
+    def start(self):
+        if self._task and not self._task.done():
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            for buf in self.buffers.values():
+                if buf.low():
+                    await buf.refill()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+prefetcher = ContentPrefetcher(CONTENT_BUFFER_SIZE, CONTENT_REFILL_INTERVAL)
+
+# ---- Content helpers ----
+
+JOKE_URL = "https://v2.jokeapi.dev/joke/Programming,Misc,Pun?blacklistFlags=explicit"
+
+def _format_joke(data: dict) -> str:
+    if data["type"] == "single":
+        return data["joke"]
+    return f'{data["setup"]} — {data["delivery"]}'
+
+def _format_trivia(q: dict) -> dict:
+    return {
+        "question": q["question"],
+        "correct_answer": q["correct_answer"],
+        "all_answers": q["incorrect_answers"] + [q["correct_answer"]],
+        "category": q["category"],
+        "difficulty": q["difficulty"]
+    }
+
+def _format_meme(data: dict) -> dict:
+    return {"title": data.get("title"), "url": data.get("url"), "author": data.get("author")}
+
+async def _fetch_jokes() -> list:
+    data = await fetch_json(f"{JOKE_URL}&amount=10")   # JokeAPI caps batches at 10
+    return [_format_joke(j) for j in data["jokes"]]
+
+async def _fetch_trivia() -> list:
+    data = await fetch_json("https://opentdb.com/api.php?amount=50&type=multiple")
+    if data["response_code"] != 0:
+        return []
+    return [_format_trivia(q) for q in data["results"]]
+
+async def _fetch_cat_facts() -> list:
+    # The facts endpoint pages through a fixed list, so start on a random page
+    data = await fetch_json(f"https://catfact.ninja/facts?limit=50&page={random.randint(1, 6)}")
+    facts = [f["fact"] for f in data["data"]]
+    random.shuffle(facts)
+    return facts
+
+async def _fetch_dog_images() -> list:
+    data = await fetch_json("https://dog.ceo/api/breeds/image/random/50")
+    return data["message"]
+
+async def _fetch_advice() -> list:
+    # Advice Slip has no batch endpoint; top up one slip per refill
+    data = await fetch_json("https://api.adviceslip.com/advice")
+    return [data["slip"]["advice"]]
+
+async def _fetch_quotes() -> list:
+    data = await fetch_json("https://zenquotes.io/api/quotes")
+    return [f'"{q["q"]}" — {q["a"]}' for q in data]
+
+async def _fetch_memes() -> list:
+    data = await fetch_json("https://meme-api.com/gimme/50")
+    return [_format_meme(m) for m in data["memes"]]
+
+prefetcher.register("joke", _fetch_jokes)
+prefetcher.register("trivia", _fetch_trivia)
+prefetcher.register("catfact", _fetch_cat_facts)
+prefetcher.register("dog", _fetch_dog_images)
+prefetcher.register("advice", _fetch_advice)
+prefetcher.register("quote", _fetch_quotes)
+prefetcher.register("meme", _fetch_memes)
 
 async def get_joke_async():
+    joke = prefetcher.pop("joke")
+    if joke:
+        return joke
     try:
-        url = "https://v2.jokeapi.dev/joke/Programming,Misc,Pun?blacklistFlags=explicit"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                data = await resp.json()
-                if data["type"] == "single":
-                    return data["joke"]
-                else:
-                    return f'{data["setup"]} — {data["delivery"]}'
+        data = await fetch_json(JOKE_URL)
+        return _format_joke(data)
     except Exception:
         return "😄 Joke generator is taking a break."
 
 async def get_trivia_question():
+    question = prefetcher.pop("trivia")
+    if question:
+        return question
     try:
-        url = "https://opentdb.com/api.php?amount=1&type=multiple"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                data = await resp.json()
-                if data["response_code"] == 0:
-                    q = data["results"][0]
-                    return {
-                        "question": q["question"],
-                        "correct_answer": q["correct_answer"],
-                        "all_answers": q["incorrect_answers"] + [q["correct_answer"]],
-                        "category": q["category"],
-                        "difficulty": q["difficulty"]
-                    }
+        data = await fetch_json("https://opentdb.com/api.php?amount=1&type=multiple")
+        if data["response_code"] == 0:
+            return _format_trivia(data["results"][0])
     except Exception:
         pass
     return None
 
 async def get_cat_fact():
+    fact = prefetcher.pop("catfact")
+    if fact:
+        return fact
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get("https://catfact.ninja/fact", timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                data = await resp.json()
-                return data.get("fact", "Cats are amazing! 🐱")
+        data = await fetch_json("https://catfact.ninja/fact")
+        return data.get("fact", "Cats are amazing! 🐱")
     except Exception:
         return "Cats are amazing! 🐱"
 
 async def get_dog_image():
+    image_url = prefetcher.pop("dog")
+    if image_url:
+        return image_url
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get("https://dog.ceo/api/breeds/image/random", timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                data = await resp.json()
-                return data.get("message")
+        data = await fetch_json("https://dog.ceo/api/breeds/image/random")
+        return data.get("message")
     except Exception:
         return None
 
 async def get_advice():
+    advice = prefetcher.pop("advice")
+    if advice:
+        return advice
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get("https://api.adviceslip.com/advice", timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                data = await resp.json()
-                return data["slip"]["advice"]
+        data = await fetch_json("https://api.adviceslip.com/advice")
+        return data["slip"]["advice"]
     except Exception:
         return "Be kind to yourself and others. 💙"
 
 async def get_quote():
+    quote = prefetcher.pop("quote")
+    if quote:
+        return quote
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get("https://zenquotes.io/api/random", timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                data = await resp.json()
-                return f'"{data[0]["q"]}" — {data[0]["a"]}'
+        data = await fetch_json("https://zenquotes.io/api/random")
+        return f'"{data[0]["q"]}" — {data[0]["a"]}'
     except Exception:
         return '"Believe you can and you\'re halfway there." — Theodore Roosevelt'
 
 async def get_meme():
+    meme = prefetcher.pop("meme")
+    if meme:
+        return meme
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get("https://meme-api.com/gimme", timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                data = await resp.json()
-                return {"title": data.get("title"), "url": data.get("url"), "author": data.get("author")}
+        data = await fetch_json("https://meme-api.com/gimme")
+        return _format_meme(data)
     except Exception:
         return None
 
 async def get_activity_suggestion():
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get("https://www.boredapi.com/api/activity", timeout=aiohttp.ClientTimeout(total=5)) as resp:
-                data = await resp.json()
-                return data.get("activity", "Try something new today!")
+        data = await fetch_json("https://www.boredapi.com/api/activity")
+        return data.get("activity", "Try something new today!")
     except Exception:
         return "Try something new today!"
 
 # ========== AI REPLY =================
+# Replies stream from the async Groq client on the event loop. A semaphore
+# caps how many completions run at once, independent of the thread pool.
+
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))   # completions in flight at once
+AI_TIMEOUT         = float(os.getenv("AI_TIMEOUT", "60"))        # seconds before a reply is abandoned
+AI_STREAM_REPLIES  = os.getenv("AI_STREAM_REPLIES", "1") == "1"  # edit the reply in place as it streams
+AI_EDIT_INTERVAL   = float(os.getenv("AI_EDIT_INTERVAL", "1.2")) # seconds between edits (Discord allows ~5 per 5s)
+AI_CACHE_SIZE      = int(os.getenv("AI_CACHE_SIZE", "1024"))     # cached replies kept (0 disables the cache)
+AI_CACHE_TTL       = float(os.getenv("AI_CACHE_TTL", "600"))     # seconds a cached reply stays valid
+AI_CACHE_MAX_PROMPT = 200                                        # longer prompts are too unique to be worth caching
+
+NO_REPLY = "🤔 I'm not sure how to answer that."
+
+groq_client = None   # AsyncGroq, created (and groq imported) on the first AI reply
+ai_slots: Optional[asyncio.Semaphore] = None
+
+def open_ai_client():
+    global groq_client, ai_slots
+    if groq_client is None:
+        from groq import AsyncGroq   # heavy import, deferred until it's needed
+        groq_client = AsyncGroq(api_key=GROQ_API_KEY)
+        ai_slots = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+    return groq_client
+
+async def close_ai_client():
+    global groq_client, ai_slots
+    if groq_client is not None:
+        await groq_client.close()
+    groq_client = None
+    ai_slots = None
+
+def normalize_prompt(text: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation so "Hi!" and "hi" match."""
+    return " ".join(text.lower().split()).rstrip(" .!?")
+
+class ReplyCache:
+    """LRU cache of AI replies with a TTL, keyed by (normalized prompt, persona key)."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl     = ttl
+        self.hits    = 0
+        self.misses  = 0
+        self._entries: OrderedDict[tuple[str, str], tuple[float, str]] = OrderedDict()
+
+    @staticmethod
+    def key(user_message: str, persona_key: str) -> Optional[tuple[str, str]]:
+        prompt = normalize_prompt(user_message)
+        if not prompt or len(prompt) > AI_CACHE_MAX_PROMPT:
+            return None
+        return prompt, persona_key
+
+    def get(self, key) -> Optional[str]:
+        entry = self._entries.get(key) if key else None
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, reply: str):
+        if not key or self.maxsize <= 0 or reply == NO_REPLY:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, reply)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+reply_cache = ReplyCache(AI_CACHE_SIZE, AI_CACHE_TTL)
+
+class SingleFlight:
+    """Lets concurrent identical prompts share one in-flight completion.
+
+    The first request for a key leads and runs the completion; anyone asking
+    for the same key meanwhile awaits the leader's future instead of calling
+    Groq again.
+    """
+
+    def __init__(self):
+        self.leaders   = 0
+        self.followers = 0
+        self._inflight: dict[tuple[str, str], asyncio.Future] = {}
+
+    def get(self, key) -> Optional[asyncio.Future]:
+        fut = self._inflight.get(key) if key else None
+        if fut is not None:
+            self.followers += 1
+        return fut
+
+    @contextmanager
+    def lead(self, key):
+        fut = asyncio.get_running_loop().create_future()
+        if key:
+            self._inflight[key] = fut
+            self.leaders += 1
+        try:
+            yield fut
+        finally:
+            if key:
+                self._inflight.pop(key, None)
+            if not fut.done():
+                fut.set_exception(RuntimeError("shared AI reply failed"))
+                fut.exception()   # followers still see it; silences "never retrieved" when there are none
+
+ai_flights = SingleFlight()
+
+# ---- Admission control ----
+# Every AI chat message takes one token from its user's, its guild's and the
+# process-wide bucket. A short wait is queued; anything longer is turned away.
+
+AI_USER_RATE       = float(os.getenv("AI_USER_RATE", "6"))        # messages per minute per user (0 = unlimited)
+AI_USER_BURST      = int(os.getenv("AI_USER_BURST", "3"))
+AI_GUILD_RATE      = float(os.getenv("AI_GUILD_RATE", "60"))      # messages per minute per guild
+AI_GUILD_BURST     = int(os.getenv("AI_GUILD_BURST", "20"))
+AI_GLOBAL_RATE     = float(os.getenv("AI_GLOBAL_RATE", "300"))    # messages per minute for the whole bot
+AI_GLOBAL_BURST    = int(os.getenv("AI_GLOBAL_BURST", "50"))
+AI_QUEUE_DEADLINE  = float(os.getenv("AI_QUEUE_DEADLINE", "5"))   # longest wait for a token before rejecting
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens  = tokens
+        self.updated = updated
+
+class RateLimiter:
+    """Token buckets keyed by ID. Idle keys fall out LRU-style, which only resets them to full."""
+
+    def __init__(self, per_minute: float, burst: int, max_keys: int = 10000):
+        self.enabled  = per_minute > 0
+        self.rate     = per_minute / 60
+        self.capacity = max(1, burst)
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[Optional[int], TokenBucket] = OrderedDict()
+
+    def _bucket(self, key, now: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.capacity, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens  = min(self.capacity, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        return bucket
+
+    def wait_time(self, key, now: float) -> float:
+        if not self.enabled:
+            return 0.0
+        bucket = self._bucket(key, now)
+        return 0.0 if bucket.tokens >= 1 else (1 - bucket.tokens) / self.rate
+
+    def take(self, key, now: float):
+        if self.enabled:
+            self._bucket(key, now).tokens -= 1
+
+class AdmissionControl:
+    def __init__(self):
+        self.users    = RateLimiter(AI_USER_RATE, AI_USER_BURST)
+        self.guilds   = RateLimiter(AI_GUILD_RATE, AI_GUILD_BURST)
+        self.global_  = RateLimiter(AI_GLOBAL_RATE, AI_GLOBAL_BURST, max_keys=1)
+        self.admitted = 0
+        self.delayed  = 0
+        self.rejected = 0
+
+    def _wait_time(self, user_id: int, guild_id: Optional[int], now: float) -> float:
+        wait = max(self.users.wait_time(user_id, now), self.global_.wait_time(None, now))
+        if guild_id is not None:
+            wait = max(wait, self.guilds.wait_time(guild_id, now))
+        return wait
+
+    async def admit(self, user_id: int, guild_id: Optional[int]) -> Optional[float]:
+        """Take a token from every bucket, waiting up to AI_QUEUE_DEADLINE for one.
+
+        A queued caller reserves its tokens before sleeping, letting the
+        balance go negative, so later callers see the queue ahead of them and
+        every caller that is told to wait is admitted when the wait ends.
+        Returns None once admitted, or the number of seconds the caller would
+        have needed to wait if it was rejected.
+        """
+        now = time.monotonic()
+        wait = self._wait_time(user_id, guild_id, now)
+        if wait > AI_QUEUE_DEADLINE:
+            self.rejected += 1
+            return wait
+        self.users.take(user_id, now)
+        self.global_.take(None, now)
+        if guild_id is not None:
+            self.guilds.take(guild_id, now)
+        self.admitted += 1
+        if wait > 0:
+            self.delayed += 1
+            await asyncio.sleep(wait)
+        return None
 
-def generate_reply(user_message: str, system_prompt: str) -> str:
-    completion = groq_client.chat.completions.create(
-        model="openai/gpt-oss-120b",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_message}
-        ],
-        temperature=1,
-        max_completion_tokens=8192,
-        top_p=1,
-        reasoning_effort="medium",
-        stream=True,
-        stop=None
-    )
+ai_admission = AdmissionControl()
+
+async def stream_reply(user_message: str, system_prompt: str):
+    """Yield the cleaned reply so far as chunks arrive.
+
+    Only the first line survives clean_output, so the upstream stream is closed
+    as soon as a line break or a role marker shows up instead of paying for the
+    rest of the completion.
+    """
+    client = open_ai_client()
+    started = time.perf_counter()
+    async with ai_slots:
+        completion = await client.chat.completions.create(
+            model="openai/gpt-oss-120b",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_message}
+            ],
+            temperature=1,
+            max_completion_tokens=8192,
+            top_p=1,
+            reasoning_effort="medium",
+            stream=True,
+            stop=None
+        )
+        text = ""
+        try:
+            async for chunk in completion:
+                piece = chunk.choices[0].delta.content or ""
+                if not piece:
+                    continue
+                if not text:
+                    ai_first_token.observe(time.perf_counter() - started)
+                text += piece
+                yield clean_output(text)
+                if "\n" in text or any(m in text.lower() for m in FORBIDDEN_MARKERS):
+                    break
+        finally:
+            # Also runs on early stop and cancellation, so the connection is released
+            ai_reply_seconds.observe(time.perf_counter() - started)
+            await completion.close()
+
+async def generate_reply(user_message: str, system_prompt: str) -> str:
     reply = ""
-    for chunk in completion:
-        reply += chunk.choices[0].delta.content or ""
-    reply = clean_output(reply)
+    async for reply in stream_reply(user_message, system_prompt):
+        pass
     if not reply:
-        return "🤔 I'm not sure how to answer that."
+        return NO_REPLY
     return reply
 
+async def send_streamed_reply(channel, user_message: str, system_prompt: str) -> Optional[str]:
+    """Post a placeholder and edit it as the reply streams in, at most once per AI_EDIT_INTERVAL.
+
+    Returns the final reply, or None if generation failed.
+    """
+    placeholder = await channel.send("💭 ...")
+    shown = ""
+
+    async def pump() -> str:
+        nonlocal shown
+        reply, last_edit = "", time.monotonic()
+        async for reply in stream_reply(user_message, system_prompt):
+            if reply and reply != shown and time.monotonic() - last_edit >= AI_EDIT_INTERVAL:
+                await placeholder.edit(content=reply[:2000])
+                shown, last_edit = reply, time.monotonic()
+        return reply or NO_REPLY
+
+    result = None
+    try:
+        final = result = await asyncio.wait_for(pump(), AI_TIMEOUT)
+    except Exception:
+        traceback.print_exc()
+        final = "⚠️ AI crashed. Please try again."
+    if final != shown:
+        await placeholder.edit(content=final[:2000])
+    return result
+
+async def reply_to_prompt(channel, user_message: str, persona_key: str):
+    """Answer an AI chat message: cache first, then any identical reply in flight, then Groq."""
+    cache_key = reply_cache.key(user_message, persona_key)
+    cached = reply_cache.get(cache_key)
+    if cached is not None:
+        await channel.send(cached)
+        return
+
+    inflight = ai_flights.get(cache_key)
+    if inflight is not None:
+        async with channel.typing():
+            try:
+                reply = await asyncio.wait_for(asyncio.shield(inflight), AI_TIMEOUT)
+            except Exception:
+                reply = "⚠️ AI crashed. Please try again."
+        await channel.send(reply)
+        return
+
+    system_prompt = PERSONAS[persona_key]
+    with ai_flights.lead(cache_key) as flight:
+        if AI_STREAM_REPLIES:
+            reply = await send_streamed_reply(channel, user_message, system_prompt)
+            if reply:
+                flight.set_result(reply)
+                reply_cache.put(cache_key, reply)
+            return
+
+        async with channel.typing():
+            try:
+                reply = await asyncio.wait_for(generate_reply(user_message, system_prompt), AI_TIMEOUT)
+                flight.set_result(reply)
+                reply_cache.put(cache_key, reply)
+            except Exception:
+                traceback.print_exc()
+                reply = "⚠️ AI crashed. Please try again."
+
+        await channel.send(reply)
+
+# ========== USER LOOKUP ===================
+# Turns user IDs into display names: the gateway cache first, then a small
+# LRU of names we fetched recently, and only then REST, with the misses
+# fetched concurrently so a cold leaderboard costs about one round trip.
+
+USER_CACHE_SIZE        = int(os.getenv("USER_CACHE_SIZE", "4096"))       # fetched names kept
+USER_CACHE_TTL         = float(os.getenv("USER_CACHE_TTL", "3600"))      # seconds a fetched name stays valid
+USER_FETCH_CONCURRENCY = int(os.getenv("USER_FETCH_CONCURRENCY", "10"))  # fetch_user calls in flight at once
+
+class UserDirectory:
+    def __init__(self, maxsize: int, ttl: float, concurrency: int):
+        self.maxsize     = maxsize
+        self.ttl         = ttl
+        self.concurrency = concurrency
+        self.hits        = 0   # served from the gateway cache or the LRU
+        self.fetches     = 0   # fetch_user calls made
+        self._names: OrderedDict[int, tuple[float, str]] = OrderedDict()   # user_id -> (expires, name)
+
+    def _cached(self, user_id: int) -> Optional[str]:
+        entry = self._names.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._names[user_id]
+            return None
+        self._names.move_to_end(user_id)
+        return entry[1]
+
+    def _remember(self, user_id: int, name: str):
+        if self.maxsize <= 0:
+            return
+        self._names[user_id] = (time.monotonic() + self.ttl, name)
+        self._names.move_to_end(user_id)
+        while len(self._names) > self.maxsize:
+            self._names.popitem(last=False)
+
+    async def names(self, bot: commands.Bot, user_ids: list[int]) -> dict[int, str]:
+        """Map each resolvable ID to its username. Users that can't be fetched are left out."""
+        found, missing = {}, []
+        for uid in user_ids:
+            user = bot.get_user(uid)
+            name = user.name if user else self._cached(uid)
+            if name is None:
+                missing.append(uid)
+            else:
+                found[uid] = name
+                self.hits += 1
+        if not missing:
+            return found
+
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(uid: int) -> Optional[str]:
+            async with slots:
+                self.fetches += 1
+                try:
+                    return (await bot.fetch_user(uid)).name
+                except discord.HTTPException:
+                    return None
+
+        for uid, name in zip(missing, await asyncio.gather(*(fetch(uid) for uid in missing))):
+            if name is not None:
+                self._remember(uid, name)
+                found[uid] = name
+        return found
+
+user_directory = UserDirectory(USER_CACHE_SIZE, USER_CACHE_TTL, USER_FETCH_CONCURRENCY)
+
+# ========== METRICS ===================
+# Optional Prometheus-style text endpoint. Collectors are plain functions that
+# return exposition lines; the bot registers its own when it is created.
+# Histograms live on the server itself, so they survive a bot rebuild.
+
+shard_events = Counter()     # (shard_id, "message" | "interaction") -> events seen
+gateway_events = Counter()   # gateway event type -> events seen
+
+def shard_for_guild(guild_id: Optional[int], shard_count: Optional[int]) -> int:
+    """Discord's shard formula; DMs always land on shard 0."""
+    if not guild_id:
+        return 0
+    return (guild_id >> 22) % (shard_count or 1)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    """A Prometheus histogram, optionally split by one label."""
+
+    def __init__(self, name: str, label: Optional[str] = None, buckets: tuple = LATENCY_BUCKETS):
+        self.name    = name
+        self.label   = label
+        self.buckets = buckets
+        self._series: dict[str, list] = {}   # label value -> [per-bucket counts..., overflow count, sum]
+
+    def observe(self, value: float, label: str = ""):
+        series = self._series.get(label)
+        if series is None:
+            series = self._series[label] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, label: str = ""):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, label)
+
+    def render(self) -> list[str]:
+        lines = [f"# TYPE {self.name} histogram"]
+        for value, series in sorted(self._series.items()):
+            prefix = f'{self.label}="{value}",' if self.label else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            cumulative += series[-2]
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+            tags = f"{{{prefix[:-1]}}}" if prefix else ""
+            lines.append(f"{self.name}_sum{tags} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{tags} {cumulative}")
+        return lines
+
+class MetricsServer:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.collectors = []
+        self.histograms: list[Histogram] = []
+        self._runner: Optional[web.AppRunner] = None
+
+    def register(self, collector):
+        self.collectors.append(collector)
+
+    def histogram(self, name: str, label: Optional[str] = None, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        hist = Histogram(name, label, buckets)
+        self.histograms.append(hist)
+        return hist
+
+    def render(self) -> str:
+        lines = []
+        for collector in self.collectors:
+            lines.extend(collector())
+        for hist in self.histograms:
+            lines.extend(hist.render())
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type="text/plain")
+
+    async def start(self):
+        if not self.port or self._runner:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        print(f"📈 Metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+
+command_seconds    = metrics_server.histogram("rune_command_seconds", "command")
+ai_first_token     = metrics_server.histogram("rune_ai_first_token_seconds")
+ai_reply_seconds   = metrics_server.histogram("rune_ai_reply_seconds")
+api_seconds        = metrics_server.histogram("rune_api_request_seconds", "api")
+data_flush_seconds = metrics_server.histogram("rune_data_flush_seconds")
+loop_lag_seconds   = metrics_server.histogram("rune_event_loop_lag_seconds", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+
+command_errors = Counter()   # command name -> invocations that raised
+api_errors     = Counter()   # api host -> failed requests
+
+class LoopLagProbe:
+    """Sleeps for a fixed interval and records how late the loop woke it up."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last     = 0.0
+        self.beat: Optional[float] = None   # monotonic time of the last wakeup, None while stopped
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task and not self._task.done():
+            return
+        self.beat  = time.monotonic()
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self.beat = None
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last = max(0.0, now - started - self.interval)
+            self.beat = now
+            loop_lag_seconds.observe(self.last)
+
+loop_lag = LoopLagProbe(0.5)
+
+# ---- Event-loop watchdog ----
+# A blocked loop can't report on itself, so a daemon thread watches the lag
+# probe's heartbeat. Once it goes stale by LOOP_STALL_THRESHOLD the thread
+# samples the loop thread's stack every few milliseconds until the loop
+# comes back, then appends a report with the hottest stacks to
+# LOOP_STALL_FILE. While the loop is healthy it just wakes ten times a second.
+
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.25"))   # seconds of lag that trigger a report (0 disables)
+LOOP_STALL_FILE      = os.getenv("LOOP_STALL_FILE", "loop_stalls.jsonl")
+LOOP_STALL_SAMPLE    = 0.005   # seconds between stack samples during a stall
+LOOP_STALL_TOP       = 5       # distinct stacks kept per report
+
+class LoopWatchdog:
+    def __init__(self, probe: LoopLagProbe, threshold: float, path: str):
+        self.probe     = probe
+        self.threshold = threshold
+        self.path      = path
+        self.stalls    = 0
+        self._loop_thread: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Watch the calling thread's event loop. Call from the loop thread.
+
+        The thread lives for the whole process; while the probe is stopped
+        (between restarts) it has no heartbeat to judge and stays idle.
+        """
+        self._loop_thread = threading.get_ident()
+        if self.threshold <= 0 or self._thread:
+            return
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def _stack(self) -> Optional[tuple[str, ...]]:
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return None
+        return tuple(
+            f"{os.path.basename(fs.filename)}:{fs.lineno} {fs.name}"
+            for fs in traceback.extract_stack(frame, limit=30)
+        )
+
+    def _watch(self):
+        limit = self.probe.interval + self.threshold
+        while True:
+            time.sleep(0.1)
+            beat = self.probe.beat
+            if beat is None or time.monotonic() - beat < limit:
+                continue
+            samples = Counter()
+            while self.probe.beat == beat:
+                stack = self._stack()
+                if stack:
+                    samples[stack] += 1
+                time.sleep(LOOP_STALL_SAMPLE)
+            if samples and self.probe.beat is not None:
+                self._report(samples)
+
+    def _report(self, samples: Counter):
+        self.stalls += 1
+        total = sum(samples.values())
+        report = {
+            "ts":         datetime.now().isoformat(timespec="milliseconds"),
+            "stalled_s":  round(self.probe.last, 3),
+            "samples":    total,
+            "stacks":     [
+                {"share": round(n / total, 3), "stack": list(stack)}
+                for stack, n in samples.most_common(LOOP_STALL_TOP)
+            ],
+        }
+        where = report["stacks"][0]["stack"][-1]
+        print(f"🐢 Event loop blocked for {report['stalled_s']:.2f}s, mostly at {where} (details in {self.path})")
+        try:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(report) + "\n")
+        except Exception as e:
+            print(f"⚠️  Could not write {self.path}: {e}")
+
+loop_watchdog = LoopWatchdog(loop_lag, LOOP_STALL_THRESHOLD, LOOP_STALL_FILE)
+
+def collect_shard_metrics(bot: commands.Bot) -> list[str]:
+    latencies = getattr(bot, "latencies", None) or [(bot.shard_id or 0, bot.latency)]
+    guild_counts = Counter(g.shard_id for g in bot.guilds)
+    lines = [
+        "# TYPE rune_shard_latency_seconds gauge",
+        *(f'rune_shard_latency_seconds{{shard="{sid}"}} {lat:.6f}' for sid, lat in latencies if lat == lat),  # skip NaN before first heartbeat
+        "# TYPE rune_shard_guilds gauge",
+        *(f'rune_shard_guilds{{shard="{sid}"}} {count}' for sid, count in sorted(guild_counts.items())),
+        "# TYPE rune_shard_events_total counter",
+        *(f'rune_shard_events_total{{shard="{sid}",kind="{kind}"}} {n}' for (sid, kind), n in sorted(shard_events.items())),
+        "# TYPE rune_gateway_events_total counter",
+        *(f'rune_gateway_events_total{{type="{etype}"}} {n}' for etype, n in sorted(gateway_events.items())),
+    ]
+    return lines
+
+def _counter_lines(name: str, label: str, counter: Counter) -> list[str]:
+    return [f"# TYPE {name} counter", *(f'{name}{{{label}="{key}"}} {n}' for key, n in sorted(counter.items()))]
+
+def collect_process_metrics() -> list[str]:
+    buffers = prefetcher.buffers
+    return [
+        "# TYPE rune_event_loop_lag_last_seconds gauge",
+        f"rune_event_loop_lag_last_seconds {loop_lag.last:.6f}",
+        "# TYPE rune_event_loop_stalls_total counter",
+        f"rune_event_loop_stalls_total {loop_watchdog.stalls}",
+        "# TYPE rune_reminders_pending gauge",
+        f"rune_reminders_pending {len(reminder_scheduler)}",
+        "# TYPE rune_views_active gauge",
+        f'rune_views_active{{kind="trivia"}} {view_states.count("trivia")}',
+        f'rune_views_active{{kind="poll"}} {view_states.count("poll")}',
+        "# TYPE rune_data_dirty_records gauge",
+        f"rune_data_dirty_records {len(persistence.dirty)}",
+        "# TYPE rune_data_flushes_total counter",
+        f"rune_data_flushes_total {persistence.flushes}",
+        "# TYPE rune_journal_events_total counter",
+        f"rune_journal_events_total {economy_journal.appended}",
+        *_counter_lines("rune_messages_total", "path", message_counters),
+        *_counter_lines("rune_command_errors_total", "command", command_errors),
+        *_counter_lines("rune_api_errors_total", "api", api_errors),
+        "# TYPE rune_ai_cache_total counter",
+        f'rune_ai_cache_total{{result="hit"}} {reply_cache.hits}',
+        f'rune_ai_cache_total{{result="miss"}} {reply_cache.misses}',
+        "# TYPE rune_ai_singleflight_total counter",
+        f'rune_ai_singleflight_total{{role="leader"}} {ai_flights.leaders}',
+        f'rune_ai_singleflight_total{{role="follower"}} {ai_flights.followers}',
+        "# TYPE rune_ai_admission_total counter",
+        f'rune_ai_admission_total{{result="admitted"}} {ai_admission.admitted}',
+        f'rune_ai_admission_total{{result="delayed"}} {ai_admission.delayed}',
+        f'rune_ai_admission_total{{result="rejected"}} {ai_admission.rejected}',
+        "# TYPE rune_user_lookups_total counter",
+        f'rune_user_lookups_total{{source="cache"}} {user_directory.hits}',
+        f'rune_user_lookups_total{{source="rest"}} {user_directory.fetches}',
+        "# TYPE rune_content_buffer_items gauge",
+        *(f'rune_content_buffer_items{{kind="{name}"}} {len(buf.items)}' for name, buf in sorted(buffers.items())),
+        "# TYPE rune_content_buffer_total counter",
+        *(f'rune_content_buffer_total{{kind="{name}",result="hit"}} {buf.hits}' for name, buf in sorted(buffers.items())),
+        *(f'rune_content_buffer_total{{kind="{name}",result="miss"}} {buf.misses}' for name, buf in sorted(buffers.items())),
+    ]
+
+def collect_view_metrics() -> list[str]:
+    return [
+        "# TYPE rune_poll_edit_requests_total counter",
+        f"rune_poll_edit_requests_total {poll_edits['requested']}",
+        "# TYPE rune_poll_edits_total counter",
+        f"rune_poll_edits_total {poll_edits['sent']}",
+        "# TYPE rune_poll_edits_saved_total counter",
+        f"rune_poll_edits_saved_total {poll_edits['requested'] - poll_edits['sent']}",
+    ]
+
+# ========== COMMAND SYNC ===================
+
+COMMAND_SYNC_FILE = f"command_sync{SHARD_FILE_SUFFIX}.json"   # {application_id: hash of the last synced command tree}
+
+class CommandSync:
+    def __init__(self, path: str):
+        self.path = path
+
+    def _load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"⚠️  Could not load {self.path}: {e}")
+            return {}
+
+    @staticmethod
+    def tree_hash(tree: app_commands.CommandTree) -> str:
+        payloads = []
+        for cmd in tree.get_commands():
+            try:
+                payloads.append(cmd.to_dict(tree))   # discord.py >= 2.4
+            except TypeError:
+                payloads.append(cmd.to_dict())
+        payloads.sort(key=lambda p: (p.get("type", 1), p["name"]))
+        return hashlib.sha256(json.dumps(payloads, sort_keys=True).encode()).hexdigest()
+
+    async def sync(self, bot: commands.Bot, force: bool = False) -> bool:
+        """Sync global commands if the tree changed since the last sync. Returns True if it synced."""
+        digest = self.tree_hash(bot.tree)
+        synced = self._load()
+        key = str(bot.application_id)
+        if not force and synced.get(key) == digest:
+            return False
+        await bot.tree.sync()
+        synced[key] = digest
+        _write_json_atomic(self.path, synced)
+        return True
+
+    async def cleanup_guilds(self, bot: commands.Bot):
+        """One-off maintenance: remove guild-scoped commands everywhere, then resync globally."""
+        for g in bot.guilds:
+            bot.tree.clear_commands(guild=g)
+            await bot.tree.sync(guild=g)
+        await self.sync(bot, force=True)
+        print(f"🧹 Cleared guild commands in {len(bot.guilds)} servers and resynced globally")
+
+command_sync = CommandSync(COMMAND_SYNC_FILE)
+
+# ============== STARTUP ==================
+# Importing the module only builds empty containers and opens files. User
+# data, reminders, saved views, filters and guild settings are read in a
+# worker thread once the event loop runs, in parallel with the gateway
+# handshake. Prefix messages wait on `data_ready`; commands and
+# button clicks wait up to DATA_READY_GRACE and are otherwise told to retry,
+# so Discord never times them out. The HTTP session and the Groq client are
+# created on first use. Each phase is timed and reported once.
+
+class StartupTimer:
+    def __init__(self, started: float):
+        self.started  = started
+        self.phases: dict[str, float] = {}
+        self.reported = False
+        self._open: dict[str, float] = {}
+
+    def begin(self, phase: str):
+        self._open[phase] = time.perf_counter()
+
+    def end(self, phase: str):
+        started = self._open.pop(phase, None)
+        if started is not None:
+            self.phases[phase] = time.perf_counter() - started
+        if not self._open and not self.reported:
+            self.reported = True
+            parts = ", ".join(f"{name} {secs * 1000:.0f}ms" for name, secs in self.phases.items())
+            print(f"⏱️  Online {time.perf_counter() - self.started:.2f}s after launch ({parts})")
+
+startup_timer = StartupTimer(_IMPORT_STARTED)
+data_ready = asyncio.Event()
+DATA_READY_GRACE = 2.0   # seconds an interaction may wait for user data; Discord wants a response within 3
+
+def _read_user_data() -> tuple[UserRecords, set]:
+    """Worker-thread half of the load: read the small state files, then parse
+    storage and replay the journal into fresh records."""
+    reminder_scheduler.load()
+    view_states.load()
+    moderation.load()
+    guild_settings.load()
+    loaded = UserRecords.from_sections(*storage.load())
+    replayed = set()
+    count = economy_journal.replay(lambda event: apply_economy_event(loaded, event, replayed))
+    if count:
+        print(f"📜 Replayed {count} economy events from {JOURNAL_DIR}/")
+    storage.seed(loaded)
+    if STATE_STORE == "shared":
+        state_store.seed(loaded.section(UserRecords.POINTS), loaded.section(UserRecords.DAILY))
+    return loaded, replayed
+
+async def load_user_data():
+    """Load user data once per process; later calls (e.g. after a cold restart) return at once."""
+    global data_ready
+    if data_ready.is_set():
+        return
+    data_ready = asyncio.Event()   # a fresh event, in case a previous loop died mid-load
+    startup_timer.begin("user data")
+    loaded, replayed = await asyncio.to_thread(_read_user_data)
+    user_records.adopt(loaded)
+    leaderboard_index.rebuild(user_points)
+    for section, uid in replayed:
+        persistence.mark(section, uid)   # replayed changes belong in the next snapshot
+    data_ready.set()
+    print(f"💾 Loaded {len(user_points)} user point records and {len(reminder_scheduler)} reminders from disk")
+    startup_timer.end("user data")
+
+async def wait_for_data(interaction: discord.Interaction) -> bool:
+    """Give user data a moment to finish loading. If it doesn't, answer the
+    interaction so Discord doesn't time it out, and return False to skip it."""
+    if data_ready.is_set():
+        return True
+    try:
+        await asyncio.wait_for(data_ready.wait(), DATA_READY_GRACE)
+        return True
+    except asyncio.TimeoutError:
+        try:
+            await interaction.response.send_message(
+                "⏳ Rune is still starting up — try again in a few seconds.", ephemeral=True
+            )
+        except discord.HTTPException:
+            pass
+        return False
+
+class GatedCommandTree(app_commands.CommandTree):
+    """Holds slash commands until user data has loaded, and times every command."""
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras["started"] = time.perf_counter()
+        return await wait_for_data(interaction)
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        name = interaction.command.qualified_name if interaction.command else "unknown"
+        command_errors[name] += 1
+        observe_command(interaction, name)
+        await super().on_error(interaction, error)
+
+def observe_command(interaction: discord.Interaction, name: str):
+    started = interaction.extras.get("started")
+    if started is not None:
+        command_seconds.observe(time.perf_counter() - started, name)
+
 # ========== BOT FACTORY ===================
 
-def create_bot():
+class RuneBotMixin:
+    """Owns the lifecycle of the shared background resources for either bot class."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.startup_hooks = []   # callables create_bot wants run once saved state has loaded
+
+    async def setup_hook(self):
+        startup_timer.begin("setup")
+        startup_timer.begin("gateway")
+        asyncio.create_task(self._load_user_data())
+        persistence.start()
+        economy_journal.start()
+        prefetcher.start()
+        loop_lag.start()
+        loop_watchdog.start()
+        await metrics_server.start()
+        startup_timer.end("setup")
+
+    async def _load_user_data(self):
+        try:
+            await load_user_data()
+        except Exception:
+            print("🔴 Could not load user data:")
+            traceback.print_exc()
+            await self.close()
+            return
+        for hook in self.startup_hooks:
+            hook()
+
+    async def close(self):
+        prefetcher.stop()
+        loop_lag.stop()
+        await reminder_scheduler.stop()
+        await view_states.stop()
+        await persistence.stop()
+        await economy_journal.stop()
+        await metrics_server.stop()
+        await close_http_session()
+        await close_ai_client()
+        await super().close()
+
+class RuneBot(RuneBotMixin, commands.Bot):
+    pass
+
+class ShardedRuneBot(RuneBotMixin, commands.AutoShardedBot):
+    pass
+
+def create_bot(cleanup_commands: bool = False):
     intents = discord.Intents.default()
     intents.message_content = True
-    intents.members = True
-
-    bot = commands.Bot(command_prefix=PREFIX, intents=intents)
+    intents.members = MEMBERS_INTENT
+
+    if SHARDED:
+        bot = ShardedRuneBot(command_prefix=PREFIX, intents=intents, tree_cls=GatedCommandTree,
+                             shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+    else:
+        bot = RuneBot(command_prefix=PREFIX, intents=intents, tree_cls=GatedCommandTree)
+    metrics_server.collectors.clear()   # drop collectors bound to a previous bot after a restart
+    metrics_server.register(lambda: collect_shard_metrics(bot))
+    metrics_server.register(collect_view_metrics)
+    metrics_server.register(collect_process_metrics)
 
     @bot.event
     async def on_ready():
         # ---------------------------------------------------------------
         # SLASH COMMAND SYNC STRATEGY
         # ---------------------------------------------------------------
-        # During development set DEV_GUILD_ID in your .env to your server's
-        # ID. Guild-scoped commands update INSTANTLY — no re-invite needed.
-        # For production (DEV_GUILD_ID not set) we sync globally; Discord
-        # can take up to 1 hour to propagate changes everywhere, but you
-        # still NEVER need to re-invite the bot for new commands.
+        # The command tree is hashed and compared with the hash saved after
+        # the last successful sync, so restarts and reconnects only hit
+        # Discord's rate-limited sync endpoint when a command changed.
+        # Global changes can take up to 1 hour to propagate everywhere, but
+        # you still NEVER need to re-invite the bot for new commands.
+        # Stale guild-specific commands are wiped by running once with
+        # `python bot.py --cleanup-commands`.
         # ---------------------------------------------------------------
-        # Wipe stale guild-specific commands from every server, then global sync
-        for g in bot.guilds:
-            bot.tree.clear_commands(guild=g)
-            await bot.tree.sync(guild=g)
-        await bot.tree.sync()
-        print("✅ Slash commands synced globally")
+        if cleanup_commands:
+            await command_sync.cleanup_guilds(bot)
+            await bot.close()
+            return
+        if await command_sync.sync(bot):
+            print("✅ Slash commands synced globally")
+        else:
+            print("✅ Slash commands unchanged, skipped sync")
 
-        check_reminders.start()
         print(f"✅ Bot online as {bot.user}")
         print(f"📊 Serving {len(bot.guilds)} servers")
-        print(f"💾 Loaded {len(user_points)} user point records from disk")
+        startup_timer.end("gateway")
+        await data_ready.wait()   # reminders load with the user data
+        reminder_scheduler.start(deliver_reminder)
+
+    @bot.event
+    async def on_app_command_completion(interaction: discord.Interaction, command):
+        observe_command(interaction, command.qualified_name)
+
+    @bot.event
+    async def on_socket_event_type(event_type: str):
+        gateway_events[event_type] += 1
+
+    @bot.event
+    async def on_interaction(interaction: discord.Interaction):
+        shard_events[(shard_for_guild(interaction.guild_id, bot.shard_count), "interaction")] += 1
 
     @bot.event
     async def on_message(message):
+        shard_events[(message.guild.shard_id if message.guild else 0, "message")] += 1
         if message.author.bot:
+            message_counters["bot"] += 1
             return
 
-        triggers = ['.joke', '.roast', '.trivia', '.meme']
-        if any(word in message.content.lower() for word in triggers):
+        content = message.content
+        is_command = content.startswith(PREFIX)
+        triggered = TRIGGER_PATTERN.search(content) is not None
+        if not is_command and not triggered:
+            message_counters["plain"] += 1
+            return
+
+        await data_ready.wait()   # guild settings and filters load with the user data
+        guild_id = message.guild.id if message.guild else None
+        if triggered and guild_settings.trigger_reactions(guild_id):
+            message_counters["reacted"] += 1
             await message.add_reaction('😎')
 
-        if not message.content.startswith(PREFIX):
+        if not is_command:
+            message_counters["no_prefix"] += 1
             return
 
-        user_input = message.content[len(PREFIX):].strip()
+        user_input = content[len(PREFIX):].strip()
         if not user_input:
+            message_counters["empty"] += 1
             return
 
         track_user_activity(message.author.id)
 
-        if is_toxic(user_input):
+        flagged = moderation.check(user_input, guild_id)
+        if flagged:
+            message_counters[flagged] += 1
+        if flagged == "toxic":
             await message.channel.send("Hey 🙂 let's keep it respectful.")
             return
 
-        if is_inappropriate(user_input):
+        if flagged == "inappropriate":
             joke = await get_joke_async()
             await message.channel.send(f"Let's keep it clean! Here's a joke instead:\n{joke}")
             return
 
-        system_prompt = get_system_prompt(message.author.id)
-        async with message.channel.typing():
-            try:
-                reply = await asyncio.to_thread(generate_reply, user_input, system_prompt)
-            except Exception:
-                traceback.print_exc()
-                reply = "⚠️ AI crashed. Please try again."
+        retry_after = await ai_admission.admit(message.author.id, guild_id)
+        if retry_after is not None:
+            message_counters["rate_limited"] += 1
+            await message.channel.send(
+                f"⏳ Whoa, slow down! Try again in **{int(retry_after) + 1}s**.", delete_after=10
+            )
+            return
 
-        await message.channel.send(reply)
+        message_counters["ai"] += 1
+        await reply_to_prompt(message.channel, user_input, get_persona_key(message.author.id))
 
     # ========== SLASH COMMANDS =================
 
@@ -390,28 +2719,90 @@ def create_bot():
         await interaction.response.send_message(compliment_text)
         track_user_activity(interaction.user.id)
 
+    # ========== PERSISTENT VIEWS (state in view_states, expiry survives restarts) ==========
+
+    class PersistentView(discord.ui.View):
+        """A view whose state lives in view_states under its message ID.
+
+        Button custom_ids carry a per-message token, so after a restart the
+        view can be rebuilt from its saved state and registered again with
+        bot.add_view. Expiry is tracked in the state instead of the view
+        timeout, which would otherwise reset on every restart.
+        """
+
+        def __init__(self, state: dict):
+            super().__init__(timeout=None)
+            self.state      = state
+            self.message_id = None
+            self.message    = None           # partial message, so it works before the cache fills
+            self._expiry: Optional[asyncio.Task] = None
+
+        async def interaction_check(self, interaction: discord.Interaction) -> bool:
+            return await wait_for_data(interaction)   # button clicks can award points
+
+        def attach(self, message_id: int):
+            self.message_id = message_id
+            self.message    = bot.get_partial_messageable(self.state["channel_id"]).get_partial_message(message_id)
+            self._expiry    = asyncio.create_task(self._expire_later())
+
+        async def _expire_later(self):
+            await asyncio.sleep(max(0.0, self.state["expires"] - time.time()))
+            if not self.is_finished():
+                await self.on_expire()
+
+        async def on_expire(self):
+            self.finish()
+
+        def finish(self):
+            self.stop()
+            view_states.drop(self.message_id)
+            if self._expiry and self._expiry is not asyncio.current_task():
+                self._expiry.cancel()
+
     # ========== TRIVIA VIEW (buttons, lockout, 5-min timer) =================
 
-    class TriviaView(discord.ui.View):
-        def __init__(self, guild_id: int, correct: str, answers: list[str], question_data: dict):
-            super().__init__(timeout=300)  # 5 minutes
-            self.guild_id   = guild_id
-            self.correct    = correct
-            self.answered   = False          # True once someone is correct
-            self.wrong_ids  = set()          # users who already guessed wrong
-            self.message    = None           # set after send so we can edit on timeout
+    TRIVIA_TIME_LIMIT = 300   # 5 minutes
+
+    def trivia_embed(state: dict) -> discord.Embed:
+        diff_colors = {"easy": discord.Color.green(), "medium": discord.Color.orange(), "hard": discord.Color.red()}
+        embed = discord.Embed(
+            title="🧠 Trivia Time!",
+            description=f"**{state['question']}**",
+            color=diff_colors.get(state["difficulty"], discord.Color.blue())
+        )
+        embed.add_field(name="📚 Category",    value=state["category"],               inline=True)
+        embed.add_field(name="⚡ Difficulty",  value=state["difficulty"].capitalize(), inline=True)
+        embed.add_field(name="⏳ Time Limit",  value="5 minutes",                      inline=True)
+        embed.set_footer(text="Press a button to answer! Wrong answers lock you out.")
+        return embed
+
+    class TriviaView(PersistentView):
+        def __init__(self, state: dict):
+            super().__init__(state)
+            self.guild_id   = state["guild_id"]
+            self.correct    = state["correct"]
+            self.answered   = False                  # True once someone is correct
+            self.wrong_ids  = set(state["wrong"])    # users who already guessed wrong
 
             letters = ["A", "B", "C", "D"]
-            for i, ans in enumerate(answers):
+            for i, ans in enumerate(state["answers"]):
                 btn = discord.ui.Button(
                     label=f"{letters[i]}. {ans[:80]}",   # truncate very long answers
                     style=discord.ButtonStyle.primary,
-                    custom_id=f"trivia_{i}",
+                    custom_id=f"trivia:{state['token']}:{i}",
                     row=i // 2
                 )
                 btn.callback = self._make_callback(ans)
                 self.add_item(btn)
 
+        def _reveal(self):
+            for item in self.children:
+                item.disabled = True
+                if item.label.split(". ", 1)[-1] == self.correct[:80]:
+                    item.style = discord.ButtonStyle.success
+                else:
+                    item.style = discord.ButtonStyle.secondary
+
         def _make_callback(self, answer: str):
             async def callback(interaction: discord.Interaction):
                 if self.answered:
@@ -428,51 +2819,43 @@ def create_bot():
                 if answer.strip().lower() == self.correct.strip().lower():
                     self.answered = True
                     active_trivia.pop(self.guild_id, None)
-                    add_points(interaction.user.id, 10)
+                    self.finish()
+                    total = await state_store.add_points(interaction.user.id, 10, reason="trivia")
                     # Disable all buttons and mark correct one green
-                    for item in self.children:
-                        item.disabled = True
-                        if item.label.split(". ", 1)[-1] == answer[:80]:
-                            item.style = discord.ButtonStyle.success
-                        else:
-                            item.style = discord.ButtonStyle.secondary
-                    self.stop()
-                    embed = self.message.embeds[0]
+                    self._reveal()
+                    embed = trivia_embed(self.state)
                     embed.color = discord.Color.green()
                     embed.set_footer(text=f"✅ {interaction.user.display_name} got it right! +10 points")
                     await interaction.response.edit_message(embed=embed, view=self)
                     await interaction.followup.send(
                         f"🎉 **{interaction.user.mention}** answered correctly and earned **10 points**!\n"
-                        f"Total: **{get_points(interaction.user.id)}** points"
+                        f"Total: **{total}** points"
                     )
                 else:
                     # Wrong — lock this user out silently (only they see it)
                     self.wrong_ids.add(interaction.user.id)
+                    self.state["wrong"].append(interaction.user.id)
+                    view_states.changed()
                     await interaction.response.send_message(
                         "❌ **Wrong answer!** You're locked out of this question.", ephemeral=True
                     )
             return callback
 
-        async def on_timeout(self):
+        async def on_expire(self):
             self.answered = True
             active_trivia.pop(self.guild_id, None)
-            for item in self.children:
-                item.disabled = True
-                if item.label.split(". ", 1)[-1] == self.correct[:80]:
-                    item.style = discord.ButtonStyle.success
-                else:
-                    item.style = discord.ButtonStyle.secondary
-            if self.message:
-                embed = self.message.embeds[0]
-                embed.color = discord.Color.red()
-                embed.set_footer(text=f"⏰ Time's up! The answer was: {self.correct}")
-                try:
-                    await self.message.edit(embed=embed, view=self)
-                    await self.message.channel.send(
-                        f"⏰ **Nobody got it!** The correct answer was: **{self.correct}**"
-                    )
-                except Exception:
-                    pass
+            self.finish()
+            self._reveal()
+            embed = trivia_embed(self.state)
+            embed.color = discord.Color.red()
+            embed.set_footer(text=f"⏰ Time's up! The answer was: {self.correct}")
+            try:
+                await self.message.edit(embed=embed, view=self)
+                await self.message.channel.send(
+                    f"⏰ **Nobody got it!** The correct answer was: **{self.correct}**"
+                )
+            except Exception:
+                pass
 
     @bot.tree.command(name="trivia", description="Start a trivia question! 🧠")
     async def trivia(interaction: discord.Interaction):
@@ -485,56 +2868,57 @@ def create_bot():
             await interaction.followup.send("⚠️ Couldn't fetch a trivia question. Try again!")
             return
 
-        correct  = question_data["correct_answer"]
-        answers  = question_data["all_answers"][:]
+        answers = question_data["all_answers"][:]
         random.shuffle(answers)
 
-        active_trivia[interaction.guild.id] = {"answer": correct, "category": question_data["category"]}
-
-        diff_colors = {"easy": discord.Color.green(), "medium": discord.Color.orange(), "hard": discord.Color.red()}
-        color = diff_colors.get(question_data["difficulty"], discord.Color.blue())
-
-        embed = discord.Embed(
-            title="🧠 Trivia Time!",
-            description=f"**{question_data['question']}**",
-            color=color
-        )
-        embed.add_field(name="📚 Category",    value=question_data["category"],               inline=True)
-        embed.add_field(name="⚡ Difficulty",  value=question_data["difficulty"].capitalize(), inline=True)
-        embed.add_field(name="⏳ Time Limit",  value="5 minutes",                             inline=True)
-        embed.set_footer(text="Press a button to answer! Wrong answers lock you out.")
-
-        view = TriviaView(interaction.guild.id, correct, answers, question_data)
-        msg  = await interaction.followup.send(embed=embed, view=view)
-        view.message = msg
+        active_trivia[interaction.guild.id] = {"answer": question_data["correct_answer"], "category": question_data["category"]}
+
+        state = {
+            "kind":       "trivia",
+            "token":      interaction.id,
+            "channel_id": interaction.channel_id,
+            "expires":    time.time() + TRIVIA_TIME_LIMIT,
+            "guild_id":   interaction.guild.id,
+            "question":   question_data["question"],
+            "category":   question_data["category"],
+            "difficulty": question_data["difficulty"],
+            "correct":    question_data["correct_answer"],
+            "answers":    answers,
+            "wrong":      [],
+        }
+        view = TriviaView(state)
+        msg  = await interaction.followup.send(embed=trivia_embed(state), view=view)
+        view_states.put(msg.id, state)
+        view.attach(msg.id)
         track_user_activity(interaction.user.id)
 
     @bot.tree.command(name="points", description="Check your points or someone else's 🏆")
     @app_commands.describe(user="User to check points for (optional)")
     async def points(interaction: discord.Interaction, user: Optional[discord.User] = None):
         target = user or interaction.user
-        pts = get_points(target.id)
+        pts = await state_store.get_points(target.id)
         embed = discord.Embed(title="🏆 Points", description=f"{target.mention} has **{pts}** points!", color=discord.Color.gold())
+        ranking = await state_store.rank(target.id)
+        if ranking is not None:
+            embed.set_footer(text=f"Rank #{ranking[0]} of {ranking[1]}")
         await interaction.response.send_message(embed=embed)
         track_user_activity(interaction.user.id)
 
     @bot.tree.command(name="leaderboard", description="View the top 10 users by points 📊")
     async def leaderboard(interaction: discord.Interaction):
-        if not user_points:
-            await interaction.response.send_message("No one has points yet! Play trivia to earn some!")
+        await interaction.response.defer()
+        sorted_users = await state_store.top(10)
+        if not sorted_users:
+            await interaction.followup.send("No one has points yet! Play trivia to earn some!")
             return
-        sorted_users = sorted(user_points.items(), key=lambda x: x[1], reverse=True)[:10]
+        names = await user_directory.names(bot, [uid for uid, _ in sorted_users])
         embed = discord.Embed(title="🏆 Top 10 Leaderboard", color=discord.Color.gold())
         medals = ["🥇", "🥈", "🥉"]
         for i, (uid, pts) in enumerate(sorted_users):
-            try:
-                u = await bot.fetch_user(uid)
-                name = u.name
-            except Exception:
-                name = f"Unknown ({uid})"
+            name = names.get(uid, f"Unknown ({uid})")
             medal = medals[i] if i < 3 else f"#{i+1}"
             embed.add_field(name=f"{medal} {name}", value=f"{pts} points", inline=False)
-        await interaction.response.send_message(embed=embed)
+        await interaction.followup.send(embed=embed)
         track_user_activity(interaction.user.id)
 
     @bot.tree.command(name="give", description="Give some of your points to another user 🎁")
@@ -549,21 +2933,20 @@ def create_bot():
         if amount <= 0:
             await interaction.response.send_message("❌ Amount must be positive!", ephemeral=True)
             return
-        sender_pts = get_points(interaction.user.id)
-        if sender_pts < amount:
+        try:
+            sender_pts, receiver_pts = await state_store.transfer(interaction.user.id, user.id, amount)
+        except InsufficientPoints as e:
             await interaction.response.send_message(
-                f"❌ You only have **{sender_pts}** points — not enough to give **{amount}**!", ephemeral=True
+                f"❌ You only have **{e.balance}** points — not enough to give **{amount}**!", ephemeral=True
             )
             return
-        user_points[interaction.user.id] = sender_pts - amount
-        add_points(user.id, amount)
         embed = discord.Embed(
             title="🎁 Points Gifted!",
             description=f"{interaction.user.mention} gave **{amount}** points to {user.mention}!",
             color=discord.Color.green()
         )
-        embed.add_field(name="Your new balance", value=f"{get_points(interaction.user.id)} pts", inline=True)
-        embed.add_field(name=f"{user.name}'s new balance", value=f"{get_points(user.id)} pts", inline=True)
+        embed.add_field(name="Your new balance", value=f"{sender_pts} pts", inline=True)
+        embed.add_field(name=f"{user.name}'s new balance", value=f"{receiver_pts} pts", inline=True)
         await interaction.response.send_message(embed=embed)
         track_user_activity(interaction.user.id)
 
@@ -571,19 +2954,16 @@ def create_bot():
     async def daily(interaction: discord.Interaction):
         uid = interaction.user.id
         now_str = datetime.now().strftime("%Y-%m-%d")
-        last_claimed = daily_claimed.get(uid)
-        if last_claimed == now_str:
+        bonus = random.randint(15, 50)
+        total = await state_store.claim_daily(uid, now_str, bonus)
+        if total is None:
             await interaction.response.send_message(
                 "⏳ You've already claimed your daily points today! Come back tomorrow.", ephemeral=True
             )
             return
-        bonus = random.randint(15, 50)
-        daily_claimed[uid] = now_str
-        add_points(uid, bonus)  # also calls save_data()
-        save_data()
         embed = discord.Embed(
             title="🌅 Daily Bonus!",
-            description=f"You claimed **{bonus}** bonus points!\nTotal: **{get_points(uid)}** points",
+            description=f"You claimed **{bonus}** bonus points!\nTotal: **{total}** points",
             color=discord.Color.yellow()
         )
         embed.set_footer(text="Come back tomorrow for more!")
@@ -603,20 +2983,18 @@ def create_bot():
         if wager <= 0:
             await interaction.response.send_message("❌ Wager must be positive!", ephemeral=True)
             return
-        if get_points(challenger.id) < wager:
-            await interaction.response.send_message(
-                f"❌ You don't have enough points! You have **{get_points(challenger.id)}**.", ephemeral=True
-            )
-            return
-        if get_points(user.id) < wager:
-            await interaction.response.send_message(
-                f"❌ {user.name} doesn't have enough points to accept this duel!", ephemeral=True
-            )
-            return
         winner = random.choice([challenger, user])
         loser = user if winner == challenger else challenger
-        user_points[loser.id] = get_points(loser.id) - wager
-        add_points(winner.id, wager)
+        try:
+            # Both sides must cover the wager; checked and settled in one atomic step
+            loser_pts, winner_pts = await state_store.transfer(loser.id, winner.id, wager, receiver_min=wager, reason="duel")
+        except InsufficientPoints as e:
+            if e.user_id == challenger.id:
+                msg = f"❌ You don't have enough points! You have **{e.balance}**."
+            else:
+                msg = f"❌ {user.name} doesn't have enough points to accept this duel!"
+            await interaction.response.send_message(msg, ephemeral=True)
+            return
         embed = discord.Embed(
             title="🪙 Coin Flip Duel!",
             description=(
@@ -626,29 +3004,35 @@ def create_bot():
             ),
             color=discord.Color.gold()
         )
-        embed.add_field(name=f"{winner.name}", value=f"{get_points(winner.id)} pts (+{wager})", inline=True)
-        embed.add_field(name=f"{loser.name}", value=f"{get_points(loser.id)} pts (-{wager})", inline=True)
+        embed.add_field(name=f"{winner.name}", value=f"{winner_pts} pts (+{wager})", inline=True)
+        embed.add_field(name=f"{loser.name}", value=f"{loser_pts} pts (-{wager})", inline=True)
         await interaction.response.send_message(embed=embed)
         track_user_activity(challenger.id)
 
     # ========== POLL VIEW (buttons, live counts, close button) =================
 
-    class PollView(discord.ui.View):
-        def __init__(self, options: list[str], creator_id: int):
-            super().__init__(timeout=86400)  # polls live for 24h max
-            self.options     = options
-            self.creator_id  = creator_id
-            self.votes: dict[int, int] = {}   # user_id -> option index
-            self.counts = [0] * len(options)
+    POLL_LIFETIME = 86400   # polls live for 24h max
+
+    class PollView(PersistentView):
+        def __init__(self, state: dict):
+            super().__init__(state)
+            self.options     = state["options"]
+            self.creator_id  = state["creator_id"]
+            self.votes: dict[int, int] = state["votes"]   # user_id -> option index, shared with the saved state
+            self.counts = [0] * len(self.options)
+            for idx in self.votes.values():
+                self.counts[idx] += 1
             self.closed  = False
-            self.message = None
+            self._dirty  = False                # votes not yet shown in the embed
+            self._last_edit = 0.0
+            self._refresh_task: Optional[asyncio.Task] = None
 
             letters = ["🇦", "🇧", "🇨", "🇩"]
-            for i, opt in enumerate(options):
+            for i, opt in enumerate(self.options):
                 btn = discord.ui.Button(
                     label=f"{letters[i]} {opt}",
                     style=discord.ButtonStyle.primary,
-                    custom_id=f"poll_opt_{i}",
+                    custom_id=f"poll:{state['token']}:{i}",
                     row=0
                 )
                 btn.callback = self._make_vote_callback(i)
@@ -657,7 +3041,7 @@ def create_bot():
             close_btn = discord.ui.Button(
                 label="🔒 Close Poll",
                 style=discord.ButtonStyle.danger,
-                custom_id="poll_close",
+                custom_id=f"poll:{state['token']}:close",
                 row=1
             )
             close_btn.callback = self.close_poll
@@ -692,7 +3076,8 @@ def create_bot():
                     await interaction.response.send_message(
                         f"✅ Voted for **{self.options[idx]}**!", ephemeral=True
                     )
-                await self._refresh_embed(interaction)
+                view_states.changed()
+                self._schedule_refresh()
             return callback
 
         async def close_poll(self, interaction: discord.Interaction):
@@ -702,10 +3087,15 @@ def create_bot():
                 )
                 return
             self.closed = True
-            self.stop()
+            self.finish()
+            if self._refresh_task:
+                self._refresh_task.cancel()   # the closed embed below shows the final counts
             for item in self.children:
                 item.disabled = True
-            await self._refresh_embed(interaction, closed=True)
+            try:
+                await interaction.response.edit_message(embed=self._build_embed(closed=True), view=self)
+            except Exception as e:
+                print(f"⚠️  Could not close poll: {e}")
 
         def _build_embed(self, closed: bool = False) -> discord.Embed:
             total = sum(self.counts)
@@ -718,22 +3108,66 @@ def create_bot():
                 desc_lines.append(f"{letters[i]} **{opt}**\n`{bar}` {count} vote{'s' if count != 1 else ''} ({pct:.1f}%)\n")
             status = "🔒 Poll Closed" if closed else "📊 Poll Active"
             embed = discord.Embed(
-                title=self.message.embeds[0].title if self.message else "📊 Poll",
+                title=self.state["title"],
                 description="\n".join(desc_lines),
                 color=discord.Color.greyple() if closed else discord.Color.blurple()
             )
             embed.set_footer(text=f"{status} • {total} total vote{'s' if total != 1 else ''}")
             return embed
 
-        async def _refresh_embed(self, interaction: discord.Interaction, closed: bool = False):
-            embed = self._build_embed(closed=closed)
-            try:
-                if closed:
-                    await interaction.response.edit_message(embed=embed, view=self)
-                else:
-                    await self.message.edit(embed=embed, view=self)
-            except Exception:
-                pass
+        def _schedule_refresh(self):
+            # Votes only touch local state; one edit per POLL_EDIT_INTERVAL carries all of them
+            poll_edits["requested"] += 1
+            self._dirty = True
+            if self._refresh_task and not self._refresh_task.done():
+                return
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+        async def _refresh_loop(self):
+            # Keep going until an edit goes out with nothing newer behind it,
+            # so the last vote is always reflected in the embed
+            failures = 0
+            while self._dirty and not self.is_finished():
+                backoff = POLL_EDIT_INTERVAL * (2 ** failures - 1)   # doubles the wait after each failed edit
+                await asyncio.sleep(max(0.0, self._last_edit + POLL_EDIT_INTERVAL + backoff - time.monotonic()))
+                if self.is_finished():
+                    return
+                self._dirty = False
+                self._last_edit = time.monotonic()
+                poll_edits["sent"] += 1
+                try:
+                    await self.message.edit(embed=self._build_embed(), view=self)
+                    failures = 0
+                except discord.NotFound:
+                    self.finish()   # the poll message was deleted; nothing left to show
+                    return
+                except Exception as e:
+                    if isinstance(e, discord.HTTPException) and 400 <= e.status < 500 and e.status != 429:
+                        # Missing permissions, archived thread, ...: no retry will get this edit through
+                        print(f"⚠️  Poll can no longer be updated, closing it: {e}")
+                        self.finish()
+                        return
+                    failures += 1
+                    if failures > POLL_REFRESH_RETRIES:
+                        print(f"⚠️  Poll refresh failed {failures} times, waiting for the next vote: {e}")
+                        return
+                    self._dirty = True   # retry so the final tally still gets shown
+                    print(f"⚠️  Poll refresh failed: {e}")
+
+    def restore_views():
+        """Rebuild every saved trivia/poll view and register it for its message."""
+        for message_id, state in list(view_states.states.items()):
+            if state["kind"] == "trivia":
+                view = TriviaView(state)
+                active_trivia[state["guild_id"]] = {"answer": state["correct"], "category": state["category"]}
+            else:
+                view = PollView(state)
+            bot.add_view(view, message_id=message_id)
+            view.attach(message_id)
+        if view_states:
+            print(f"🔁 Reattached {view_states.count('trivia')} trivia and {view_states.count('poll')} poll views")
+
+    bot.startup_hooks.append(restore_views)
 
     @bot.tree.command(name="poll", description="Create a professional poll with live vote counts 📊")
     @app_commands.describe(
@@ -763,9 +3197,21 @@ def create_bot():
         )
         embed.set_footer(text=f"Poll by {interaction.user.display_name} • 0 total votes • Click a button to vote!")
 
-        view = PollView(options, interaction.user.id)
+        state = {
+            "kind":       "poll",
+            "token":      interaction.id,
+            "channel_id": interaction.channel_id,
+            "expires":    time.time() + POLL_LIFETIME,
+            "title":      embed.title,
+            "creator_id": interaction.user.id,
+            "options":    options,
+            "votes":      {},
+        }
+        view = PollView(state)
         await interaction.response.send_message(embed=embed, view=view)
-        view.message = await interaction.original_response()
+        msg = await interaction.original_response()
+        view_states.put(msg.id, state)
+        view.attach(msg.id)
         track_user_activity(interaction.user.id)
 
     @bot.tree.command(name="serverinfo", description="View info about this server 🏠")
@@ -886,13 +3332,7 @@ def create_bot():
         if minutes < 1 or minutes > 1440:
             await interaction.response.send_message("❌ Please set a reminder between 1 and 1440 minutes!")
             return
-        remind_time = datetime.now() + timedelta(minutes=minutes)
-        reminders.append({
-            "user_id": interaction.user.id,
-            "channel_id": interaction.channel.id,
-            "message": message,
-            "time": remind_time
-        })
+        reminder_scheduler.add(interaction.user.id, interaction.channel.id, message, time.time() + minutes * 60)
         await interaction.response.send_message(
             f"⏰ Reminder set! I'll remind you in **{minutes} minute(s)** about: {message}"
         )
@@ -907,7 +3347,7 @@ def create_bot():
         persona = user_personas.get(interaction.user.id, "default")
         embed = discord.Embed(title="📊 Your Statistics", color=discord.Color.blue())
         embed.add_field(name="Commands Used", value=s["commands_used"], inline=True)
-        embed.add_field(name="Points", value=get_points(interaction.user.id), inline=True)
+        embed.add_field(name="Points", value=await state_store.get_points(interaction.user.id), inline=True)
         embed.add_field(name="AI Persona", value=persona.capitalize(), inline=True)
         embed.add_field(name="Last Seen", value=s["last_seen"].strftime("%Y-%m-%d %H:%M:%S"), inline=False)
         await interaction.response.send_message(embed=embed)
@@ -927,7 +3367,7 @@ def create_bot():
     ])
     async def persona(interaction: discord.Interaction, style: str):
         user_personas[interaction.user.id] = style
-        save_data()
+        persistence.mark("user_personas", interaction.user.id)
         descriptions = {
             "default": "Back to normal — helpful and friendly! 😊",
             "sarcastic": "Oh great, you picked sarcastic. Wonderful choice. 🙄",
@@ -1039,6 +3479,63 @@ def create_bot():
         if isinstance(error, app_commands.MissingPermissions):
             await interaction.response.send_message("❌ You need the **Moderate Members** permission to use this!", ephemeral=True)
 
+    @bot.tree.command(name="filter", description="Manage this server's extra filtered words 🧹")
+    @app_commands.describe(action="Add, remove or list words", category="Which filter list", word="Word or phrase (for add/remove)")
+    @app_commands.choices(
+        action=[
+            app_commands.Choice(name="Add", value="add"),
+            app_commands.Choice(name="Remove", value="remove"),
+            app_commands.Choice(name="List", value="list")
+        ],
+        category=[
+            app_commands.Choice(name="Toxic (blocked)", value="toxic"),
+            app_commands.Choice(name="Inappropriate (answered with a joke)", value="inappropriate")
+        ]
+    )
+    @app_commands.checks.has_permissions(manage_guild=True)
+    async def filter_words(interaction: discord.Interaction, action: str, category: str, word: Optional[str] = None):
+        if not interaction.guild:
+            await interaction.response.send_message("This command can only be used in a server.", ephemeral=True)
+            return
+        gid = interaction.guild.id
+        if action == "list":
+            words = sorted(moderation.words(gid, category))
+            listing = ", ".join(f"`{w}`" for w in words) if words else "*No extra words yet.*"
+            await interaction.response.send_message(f"🧹 **{category.capitalize()}** words for this server: {listing}", ephemeral=True)
+            return
+        if not word or not word.strip():
+            await interaction.response.send_message("❌ Please give a word to add or remove!", ephemeral=True)
+            return
+        word = word.strip()
+        if action == "add":
+            moderation.add_word(gid, category, word)
+            await interaction.response.send_message(f"✅ Added `{word}` to the **{category}** filter.", ephemeral=True)
+        elif moderation.remove_word(gid, category, word):
+            await interaction.response.send_message(f"🗑️ Removed `{word}` from the **{category}** filter.", ephemeral=True)
+        else:
+            await interaction.response.send_message(f"❌ `{word}` isn't in this server's **{category}** filter.", ephemeral=True)
+
+    @bot.tree.command(name="reactions", description="Turn the 😎 reaction to .joke/.roast/.trivia/.meme on or off 😎")
+    @app_commands.describe(enabled="Whether Rune reacts to trigger words in this server")
+    @app_commands.checks.has_permissions(manage_guild=True)
+    async def reactions(interaction: discord.Interaction, enabled: bool):
+        if not interaction.guild:
+            await interaction.response.send_message("This command can only be used in a server.", ephemeral=True)
+            return
+        guild_settings.set_trigger_reactions(interaction.guild.id, enabled)
+        state = "on ✅" if enabled else "off 🔕"
+        await interaction.response.send_message(f"😎 Trigger reactions are now **{state}** for this server.", ephemeral=True)
+
+    @reactions.error
+    async def reactions_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+        if isinstance(error, app_commands.MissingPermissions):
+            await interaction.response.send_message("❌ You need the **Manage Server** permission to use this!", ephemeral=True)
+
+    @filter_words.error
+    async def filter_words_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+        if isinstance(error, app_commands.MissingPermissions):
+            await interaction.response.send_message("❌ You need the **Manage Server** permission to use this!", ephemeral=True)
+
     # ========== HELP COMMAND =================
 
     @bot.tree.command(name="help", description="View all available commands 📖")
@@ -1055,7 +3552,7 @@ def create_bot():
             ("🐾 **Animals**", "`/catfact`, `/dog`"),
             ("💡 **Inspiration**", "`/advice`, `/quote`, `/activity`"),
             ("🎭 **AI Persona**", "`/persona` — Change how Rune talks to you (your choice is private!)"),
-            ("🛡️ **Moderation**", "`/kick`, `/ban`, `/mute`, `/unmute` *(requires permissions)*"),
+            ("🛡️ **Moderation**", "`/kick`, `/ban`, `/mute`, `/unmute`, `/filter`, `/reactions` *(requires permissions)*"),
             ("⏰ **Utility**", "`/remind`, `/stats`, `/serverinfo`, `/help`"),
             ("💬 **AI Chat**", f"Use `{PREFIX}` prefix to chat with AI (e.g., `{PREFIX}hello`)"),
         ]
@@ -1066,38 +3563,99 @@ def create_bot():
 
     # ========== BACKGROUND TASKS =================
 
-    @tasks.loop(seconds=30)
-    async def check_reminders():
-        now = datetime.now()
-        for reminder in reminders[:]:
-            if now >= reminder["time"]:
-                try:
-                    channel = bot.get_channel(reminder["channel_id"])
-                    user = await bot.fetch_user(reminder["user_id"])
-                    if channel:
-                        await channel.send(f"⏰ {user.mention} Reminder: **{reminder['message']}**")
-                    reminders.remove(reminder)
-                except Exception as e:
-                    print(f"Error sending reminder: {e}")
-                    reminders.remove(reminder)
+    async def deliver_reminder(reminder: dict):
+        # A mention only needs the ID, so no user lookup is required at all
+        channel = bot.get_channel(reminder["channel_id"]) or bot.get_partial_messageable(reminder["channel_id"])
+        await channel.send(f"⏰ <@{reminder['user_id']}> Reminder: **{reminder['message']}**")
 
     return bot
 
 # ========== AUTO-RESTART LOOP ==============
+# discord.py already resumes the gateway session on its own for ordinary
+# disconnects. The supervisor handles what escapes bot.connect(): it flushes
+# durable state, backs off with jitter and reconnects the *same* bot, so the
+# command tree, caches and live trivia/poll views all survive. Only when the
+# supervisor itself fails does run_forever fall back to a cold rebuild.
+
+RESTART_MAX_DELAY = float(os.getenv("RESTART_MAX_DELAY", "300"))   # cap for the exponential backoff
+FATAL_ERRORS = (discord.LoginFailure, discord.PrivilegedIntentsRequired)
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff from RESTART_DELAY, capped, with jitter so shards don't reconnect in lockstep."""
+    ceiling = min(RESTART_MAX_DELAY, RESTART_DELAY * 2 ** attempt)
+    return random.uniform(ceiling / 2, ceiling)
+
+async def flush_state():
+    await persistence.flush()
+    await reminder_scheduler.save()
+
+async def supervise():
+    bot = create_bot()
+    attempt = 0
+    async with bot:   # closes the bot (and flushes everything) however we leave
+        await bot.login(DISCORD_TOKEN)
+        while True:
+            connected_at = time.monotonic()
+            try:
+                await bot.connect(reconnect=True)
+                return   # bot.close() was called
+            except FATAL_ERRORS:
+                raise
+            except Exception:
+                if bot.is_closed():
+                    raise   # discord.py already tore this client down; run_forever rebuilds it
+                print("🔴 GATEWAY CRASHED:")
+                traceback.print_exc()
+            await flush_state()
+            if time.monotonic() - connected_at > RESTART_MAX_DELAY:
+                attempt = 0   # it was healthy for a while, start the backoff over
+            delay = backoff_delay(attempt)
+            attempt += 1
+            print(f"♻️ Reconnecting in {delay:.1f} seconds...\n")
+            await asyncio.sleep(delay)
 
 def run_forever():
+    discord.utils.setup_logging()
+    attempt = 0
     while True:
+        started_at = time.monotonic()
         try:
-            bot = create_bot()
-            bot.run(DISCORD_TOKEN)
+            asyncio.run(supervise())
+            return
+        except KeyboardInterrupt:
+            return
+        except FATAL_ERRORS as e:
+            # A bad token or a missing privileged intent won't fix itself by retrying
+            print(f"🔴 Can't connect: {e}")
+            sys.exit(1)
         except Exception:
             print("🔴 BOT CRASHED:")
             traceback.print_exc()
-            print(f"♻️ Restarting in {RESTART_DELAY} seconds...\n")
-            time.sleep(RESTART_DELAY)
+            if time.monotonic() - started_at > RESTART_MAX_DELAY:
+                attempt = 0   # it was healthy for a while, start the backoff over
+            delay = backoff_delay(attempt)
+            attempt += 1
+            print(f"♻️ Restarting in {delay:.1f} seconds...\n")
+            time.sleep(delay)
+        finally:
+            # Tasks died with the event loop; write whatever they had not flushed yet
+            save_data()
 
 # ============== START =====================
 
+startup_timer.phases["import"] = time.perf_counter() - _IMPORT_STARTED
+
+def run_command_cleanup():
+    bot = create_bot(cleanup_commands=True)
+    bot.run(DISCORD_TOKEN)
+
 if __name__ == "__main__":
-    print("🚀 Starting Rune Bot...")
-    run_forever()
\ No newline at end of file
+    try:
+        if "--cleanup-commands" in sys.argv:
+            print("🧹 Cleaning up guild slash commands...")
+            run_command_cleanup()
+        else:
+            print("🚀 Starting Rune Bot...")
+            run_forever()
+    finally:
+        close_storage()
\ No newline at end of file